@@ -6,11 +6,13 @@
 pkgs="
 auditd
 build-essential
+dnsutils
 docker-engine=1.12.6-0~ubuntu-xenial
 gcc
 htop
 iproute
 jq
+keyutils
 libdatetime-perl
 libgcrypt11-dev
 libffi-dev
@@ -4,6 +4,7 @@ pkgs="
 boto
 boto3
 botocore
+cryptography
 requests
 stups-berry
 stups-tokens
@@ -1,5 +1,5 @@
 #!/bin/bash
 
-curl -L  https://github.com/coreos/etcd/releases/download/v2.0.11/etcd-v2.0.11-linux-amd64.tar.gz -o etcd-v2.0.11-linux-amd64.tar.gz
-tar xzvf etcd-v2.0.11-linux-amd64.tar.gz
-mv etcd-v2.0.11-linux-amd64 /opt/etcd
+curl -L  https://github.com/coreos/etcd/releases/download/v2.3.8/etcd-v2.3.8-linux-amd64.tar.gz -o etcd-v2.3.8-linux-amd64.tar.gz
+tar xzvf etcd-v2.3.8-linux-amd64.tar.gz
+mv etcd-v2.3.8-linux-amd64 /opt/etcd
@@ -11,13 +11,20 @@ tests/check-bash-script-syntax.sh
 
 echo "### python doctests"
 python3 -m doctest -v runtime/usr/local/lib/python3.5/dist-packages/taupage/__init__.py
+PYTHONPATH=runtime/usr/local/lib/python3.5/dist-packages python3 -m doctest -v runtime/usr/local/lib/python3.5/dist-packages/taupage/timeline.py
+PYTHONPATH=runtime/usr/local/lib/python3.5/dist-packages python3 -m doctest -v runtime/usr/local/lib/python3.5/dist-packages/taupage/kms.py
+PYTHONPATH=runtime/usr/local/lib/python3.5/dist-packages python3 -m doctest -v runtime/usr/local/lib/python3.5/dist-packages/taupage/registry.py
 PYTHONPATH=runtime/usr/local/lib/python3.5/dist-packages python3 -m doctest -v runtime/opt/taupage/runtime/Docker.py
 PYTHONPATH=runtime/usr/local/lib/python3.5/dist-packages python3 -m doctest -v runtime/opt/taupage/init.d/03-push-taupage-yaml.py
 PYTHONPATH=runtime/usr/local/lib/python3.5/dist-packages python3 -m doctest -v runtime/opt/taupage/init.d/10-prepare-disks.py
 PYTHONPATH=runtime/usr/local/lib/python3.5/dist-packages python3 -m doctest -v runtime/opt/taupage/bin/push-audit-logs.py
+PYTHONPATH=runtime/usr/local/lib/python3.5/dist-packages python3 -m doctest -v runtime/opt/taupage/bin/register-in-etcd.py
+PYTHONPATH=runtime/usr/local/lib/python3.5/dist-packages python3 -m doctest -v runtime/opt/taupage/bin/run-init-scripts.py
+PYTHONPATH=runtime/usr/local/lib/python3.5/dist-packages python3 -m doctest -v runtime/opt/taupage/healthcheck/elb.py
 
 echo "### python unittests"
 PYTHONPATH=runtime/usr/local/lib/python3.5/dist-packages:runtime/opt/taupage/healthcheck python3 tests/python/test_elbHealthChecker.py
+PYTHONPATH=runtime/usr/local/lib/python3.5/dist-packages python3 tests/python/test_etcdRegistration.py
 
 echo "#################################"
 echo "# Tests completed successfully! #"
@@ -1,35 +1,32 @@
 #!/usr/bin/env python3
 '''
+Decrypt KMS encrypted values given as (base64 encoded) arguments, one plaintext per line
+
 This helper is inspired by https://github.com/zalando/kmsclient
 '''
 
-import boto3
 import base64
-import requests
+import binascii
 import sys
 
-# fetch AWS metadata for EC2 instance region
-r = requests.get('http://169.254.169.254/latest/meta-data/placement/availability-zone')
-region_name = r.text[:-1]
-
+from taupage.kms import decrypt_ciphertexts
 
-def awsKmsClient(region_name, aws_access_key, aws_secret_key):
-    return boto3.client(service_name='kms', region_name=region_name,
-                        aws_secret_access_key=aws_access_key,
-                        aws_access_key_id=aws_secret_key
-                        )
 
+def main():
+    ciphertexts = sys.argv[1:]
+    valid = []
+    for ciphertext in ciphertexts:
+        try:
+            base64.b64decode(ciphertext)
+            valid.append(ciphertext)
+        except (ValueError, binascii.Error):
+            pass
 
-def aws_decrypt(to_decrypt, region, aws_access_key, aws_secret_key):
-    client = awsKmsClient(region, aws_access_key, aws_secret_key)
-    response = client.decrypt(
-        CiphertextBlob=base64.b64decode(to_decrypt)
-    )
-    return str(response['Plaintext'], "UTF-8")
+    # decrypt all values in one batch
+    plaintexts = decrypt_ciphertexts(valid)
+    for ciphertext in ciphertexts:
+        print(plaintexts.get(ciphertext, 'Invalid KMS key.'))
 
 
-for arg in sys.argv[1:]:
-    try:
-        print(aws_decrypt(arg, region_name, aws_access_key=None, aws_secret_key=None))
-    except ValueError:
-        print("Invalid KMS key.")
+if __name__ == '__main__':
+    main()
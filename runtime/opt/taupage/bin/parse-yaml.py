@@ -6,8 +6,11 @@ Generate script output to fill environment variables from given YAML file
 import argparse
 import re
 import shlex
+import sys
 import yaml
 
+from taupage import get_config
+
 VALID_KEY_PATTERN = re.compile('^[a-zA-Z0-9_]+$')
 
 
@@ -22,7 +25,8 @@ def collect_env_vars(data: dict, env_vars: dict, path: str):
 
 
 def main(args):
-    data = yaml.safe_load(args.file)
+    # "-" reads the YAML from stdin (not snapshotted)
+    data = yaml.safe_load(sys.stdin) if args.file == '-' else get_config(args.file)
 
     env_vars = {}
     collect_env_vars(data, env_vars, args.prefix)
@@ -33,7 +37,7 @@ def main(args):
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('file', type=argparse.FileType('r'))
+    parser.add_argument('file', help='YAML file or "-" for stdin')
     parser.add_argument('prefix')
     parser.add_argument('--export', action='store_true')
 
@@ -1,49 +1,321 @@
 #!/usr/bin/env python3
 
-import boto.utils
-import codecs
 import glob
-import gzip
 import json
 import logging
 import os
 import random
 import requests
+import requests.adapters
+import socket
 import sys
+import tempfile
+import threading
 import time
+import zlib
 
-from taupage import configure_logging, get_config, get_boot_time
+from concurrent.futures import ThreadPoolExecutor
+from taupage import atomic_write, configure_logging, get_config, get_boot_time, get_instance_identity
+from taupage.timeline import format_metric, write_textfile
 from base64 import b64encode
 
+CURRENT_AUDIT_LOG = '/var/log/audit.log'
+ROTATED_AUDIT_LOGS = '/var/log/audit.log.*.gz'
+QUEUE_STATE_FILE = '/var/lib/taupage/audit-log-queue.json'
+AUDIT_LOG_PROM_FILE = 'taupage_audit_logs.prom'
 
-def push_audit_log(config: dict, instance_logs_url, account_id, region, instance_id, boot_time, fn, compress=False):
-    userAndPass = b64encode(bytes('{}:{}'.format(
+MAX_CONCURRENT_UPLOADS = 4
+CONNECT_TIMEOUT_SECONDS = 5
+READ_TIMEOUT_SECONDS = 60
+BACKOFF_BASE_SECONDS = 30
+BACKOFF_MAX_SECONDS = 900
+POLL_MIN_SECONDS = 60
+POLL_MAX_SECONDS = 300
+
+# maximum number of (uncompressed) bytes of an audit log sent in one request
+AUDIT_LOG_CHUNK_BYTES = 16 * 1024 * 1024
+# multiple of 3, so the base64 encoding of the blocks can simply be concatenated
+READ_BLOCK_BYTES = 3 * 64 * 1024
+# compressed chunks larger than this are spooled to disk
+SPOOL_MEMORY_BYTES = 1024 * 1024
+
+
+class Base64JsonPayload:
+    """
+    Request body streaming a JSON object with one base64 encoded field read from a file object
+
+    The length is known up front, so requests sends a Content-Length instead of chunked encoding.
+
+    >>> import io
+    >>> payload = Base64JsonPayload({'log_type': 'AUDIT_LOG'}, 'log_data', io.BytesIO(b'hello'), 5)
+    >>> body = b''.join(payload)
+    >>> len(body) == len(payload), json.loads(body.decode('utf-8')) == {'log_type': 'AUDIT_LOG', 'log_data': 'aGVsbG8='}
+    (True, True)
+    """
+
+    def __init__(self, fields: dict, field: str, fd, size: int):
+        self.prefix = (json.dumps(fields, sort_keys=True)[:-1] + ', {}: "'.format(json.dumps(field))).encode('utf-8')
+        self.suffix = b'"}'
+        self.fd = fd
+        self.size = size
+
+    def __len__(self):
+        return len(self.prefix) + 4 * ((self.size + 2) // 3) + len(self.suffix)
+
+    def __iter__(self):
+        yield self.prefix
+        while True:
+            block = self.fd.read(READ_BLOCK_BYTES)
+            if not block:
+                break
+            yield b64encode(block)
+        yield self.suffix
+
+
+def spool_chunk(fd, size: int, compress: bool):
+    """
+    Copy (and gzip) up to size bytes of fd into a temporary file, return it (rewound) and its size
+
+    >>> import gzip, io
+    >>> spool, length = spool_chunk(io.BytesIO(b'abc' * 1000), 3000, compress=True)
+    >>> gzip.decompress(spool.read()) == b'abc' * 1000, length < 3000
+    (True, True)
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_BYTES)
+    # every chunk is a complete gzip member, so the concatenated chunks are a valid gzip file
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS) if compress else None
+    remaining = size
+    while remaining > 0:
+        block = fd.read(min(READ_BLOCK_BYTES, remaining))
+        if not block:
+            break
+        remaining -= len(block)
+        spool.write(compressor.compress(block) if compressor else block)
+    if compressor:
+        spool.write(compressor.flush())
+    length = spool.tell()
+    spool.seek(0)
+    return spool, length
+
+
+def chunk_count(size: int, chunk_bytes=AUDIT_LOG_CHUNK_BYTES):
+    """
+    >>> chunk_count(0), chunk_count(1), chunk_count(AUDIT_LOG_CHUNK_BYTES), chunk_count(AUDIT_LOG_CHUNK_BYTES + 1)
+    (1, 1, 1, 2)
+    """
+    return max(1, (size + chunk_bytes - 1) // chunk_bytes)
+
+
+def backoff_delay(attempts: int, base=BACKOFF_BASE_SECONDS, cap=BACKOFF_MAX_SECONDS):
+    """
+    Exponential backoff with jitter for the next attempt to push a log
+
+    >>> BACKOFF_BASE_SECONDS / 2 <= backoff_delay(0) <= BACKOFF_BASE_SECONDS * 1.5
+    True
+
+    >>> backoff_delay(100) <= BACKOFF_MAX_SECONDS * 1.5
+    True
+    """
+    return min(cap, base * 2 ** min(attempts, 20)) * random.uniform(0.5, 1.5)
+
+
+def file_key(st: os.stat_result):
+    """Rotated logs are renamed every hour (audit.log.1.gz -> audit.log.2.gz), so files are identified by inode"""
+    return '{}:{}'.format(st.st_ino, st.st_size)
+
+
+class RetryQueue:
+    """
+    Durable state of pending audit logs: failed attempts, next attempt and pushed chunks per file
+
+    The files themselves are the queue, the state survives restarts of the pusher and reboots.
+    """
+
+    def __init__(self, path=QUEUE_STATE_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path) as fd:
+                self.state = json.load(fd)
+        except Exception:
+            self.state = {}
+        self.state.setdefault('files', {})
+        self.state.setdefault('shipped_bytes', 0)
+        self.state.setdefault('failures', 0)
+
+    def save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            atomic_write(self.path, json.dumps(self.state))
+        except Exception as e:
+            logging.warning('Could not save audit log queue state: {}'.format(e))
+
+    def entry(self, key: str):
+        with self.lock:
+            return dict(self.state['files'].get(key, {}))
+
+    def is_due(self, key: str, now: float):
+        return self.entry(key).get('next_attempt', 0) <= now
+
+    def chunk_done(self, key: str, sequence: int, length: int):
+        with self.lock:
+            self.state['files'].setdefault(key, {})['chunks_done'] = sequence + 1
+            self.state['shipped_bytes'] += length
+            self.save()
+
+    def failed(self, key: str):
+        with self.lock:
+            entry = self.state['files'].setdefault(key, {})
+            entry['attempts'] = entry.get('attempts', 0) + 1
+            entry['next_attempt'] = time.time() + backoff_delay(entry['attempts'] - 1)
+            self.state['failures'] += 1
+            self.save()
+
+    def done(self, key: str):
+        with self.lock:
+            self.state['files'].pop(key, None)
+            self.save()
+
+    def forget_missing(self, keys):
+        """Drop the state of files which do not exist anymore (e.g. deleted by logrotate)"""
+        with self.lock:
+            for key in set(self.state['files']) - set(keys):
+                del self.state['files'][key]
+            self.save()
+
+
+class AuditLogShipper:
+    """Pushes audit logs over one keep-alive session, several rotated logs concurrently"""
+
+    def __init__(self, config: dict, identity: dict, boot_time, queue: RetryQueue, max_workers=MAX_CONCURRENT_UPLOADS):
+        self.url = config.get('instance_logs_url')
+        user_and_pass = b64encode(bytes('{}:{}'.format(
             config.get('logsink_username'),
             config.get('logsink_password')),
-            encoding='ascii')).decode("ascii") or ''
-
-    with open(fn, 'rb') as fd:
-        contents = fd.read()
-    if compress:
-        contents = gzip.compress(contents)
-    logging.info('Pushing {} ({} Bytes) to {}..'.format(fn, len(contents), instance_logs_url))
-    data = {'account_id': str(account_id),
-            'region': region,
-            'instance_boot_time': boot_time,
-            'instance_id': instance_id,
-            'log_data': codecs.encode(contents, 'base64').decode('utf-8'),
-            'log_type': 'AUDIT_LOG'}
+            encoding='ascii')).decode("ascii")
+        self.headers = {'Content-Type': 'application/json',
+                        'Authorization': 'Basic {}'.format(user_and_pass)}
+        self.fields = {'account_id': str(identity['accountId']),
+                       'region': identity['region'],
+                       'instance_boot_time': boot_time,
+                       'instance_id': identity['instanceId'],
+                       'log_type': 'AUDIT_LOG'}
+        self.queue = queue
+        self.max_workers = max_workers
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def push_audit_log(self, fn, compress=False):
+        """
+        Push an audit log with bounded memory, large logs are split into chunks
+
+        Chunks carry "chunk_sequence" and "chunk_count" (only if there is more than
+        one), concatenating their decoded log_data gives the complete (gzipped) log.
+        Rotated logs continue with the first chunk not pushed yet.
+        """
+        with open(fn, 'rb') as fd:
+            st = os.fstat(fd.fileno())
+            key = file_key(st)
+            count = chunk_count(st.st_size)
+            # the current log is still growing, it is always pushed completely
+            first = 0 if compress else self.queue.entry(key).get('chunks_done', 0)
+            fd.seek(first * AUDIT_LOG_CHUNK_BYTES)
+            for sequence in range(first, count):
+                spool, length = spool_chunk(fd, AUDIT_LOG_CHUNK_BYTES, compress)
+                with spool:
+                    chunk = ' (chunk {}/{})'.format(sequence + 1, count) if count > 1 else ''
+                    logging.info('Pushing {}{} ({} Bytes) to {}..'.format(fn, chunk, length, self.url))
+                    fields = dict(self.fields)
+                    if count > 1:
+                        fields['chunk_sequence'] = sequence
+                        fields['chunk_count'] = count
+                    try:
+                        payload = Base64JsonPayload(fields, 'log_data', spool, length)
+                        response = self.session.post(self.url, data=payload, headers=self.headers,
+                                                     timeout=(CONNECT_TIMEOUT_SECONDS, READ_TIMEOUT_SECONDS))
+                        if response.status_code != 201:
+                            logging.warn('Failed to push audit log: server returned HTTP status {}: {}'.format(
+                                         response.status_code, response.text))
+                            self.queue.failed(key)
+                            return False
+                    except Exception:
+                        logging.exception('Failed to push audit log')
+                        self.queue.failed(key)
+                        return False
+                self.queue.chunk_done(key, sequence, length)
+        remove_file(fn, st.st_ino)
+        self.queue.done(key)
+        return True
+
+    def push_all(self, filenames, ignore_backoff=False):
+        """Push all given logs which are due, return the number of successfully pushed logs"""
+        now = time.time()
+        due = []
+        for fn in filenames:
+            try:
+                if ignore_backoff or self.queue.is_due(file_key(os.stat(fn)), now):
+                    due.append(fn)
+            except FileNotFoundError:
+                pass
+        if not due:
+            return 0
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(due))) as executor:
+            return sum(executor.map(self.push_audit_log, due))
+
+
+def remove_file(fn, inode: int):
+    """Remove a pushed log, even if logrotate renamed it in the meantime"""
+    for candidate in [fn] + sorted(glob.glob(ROTATED_AUDIT_LOGS)):
+        try:
+            if os.stat(candidate).st_ino == inode:
+                os.remove(candidate)
+                return
+        except FileNotFoundError:
+            pass
+
+
+def rotated_logs():
+    return sorted(glob.glob(ROTATED_AUDIT_LOGS))
+
+
+def write_metrics(queue: RetryQueue, filenames):
+    """Export backlog and shipped bytes as Prometheus textfile"""
+    now = time.time()
+    backlog_bytes = 0
+    oldest = now
+    keys = []
+    for fn in filenames:
+        try:
+            st = os.stat(fn)
+        except FileNotFoundError:
+            continue
+        keys.append(file_key(st))
+        backlog_bytes += st.st_size
+        oldest = min(oldest, st.st_mtime)
+    queue.forget_missing(keys)
+
+    labels = {'hostname': socket.gethostname()}
+    metrics = [
+        ('taupage_audit_log_backlog_files', 'gauge', 'Number of rotated audit logs not pushed yet', len(keys)),
+        ('taupage_audit_log_backlog_bytes', 'gauge', 'Size of the rotated audit logs not pushed yet', backlog_bytes),
+        ('taupage_audit_log_backlog_age_seconds', 'gauge', 'Age of the oldest audit log not pushed yet',
+         now - oldest),
+        ('taupage_audit_log_shipped_bytes_total', 'counter', 'Bytes of audit logs pushed',
+         queue.state['shipped_bytes']),
+        ('taupage_audit_log_push_failures_total', 'counter', 'Failed attempts to push an audit log',
+         queue.state['failures']),
+    ]
+    lines = []
+    for name, metric_type, description, value in metrics:
+        lines += ['# HELP {} {}'.format(name, description),
+                  '# TYPE {} {}'.format(name, metric_type),
+                  format_metric(name, labels, value)]
     try:
-        response = requests.post(instance_logs_url, data=json.dumps(data),
-                                 headers={'Content-Type': 'application/json',
-                                          'Authorization': 'Basic {}'.format(userAndPass)})
-        if response.status_code == 201:
-            os.remove(fn)
-        else:
-            logging.warn('Failed to push audit log: server returned HTTP status {}: {}'.format(
-                         response.status_code, response.text))
-    except Exception:
-        logging.exception('Failed to push audit log')
+        write_textfile(AUDIT_LOG_PROM_FILE, lines)
+    except Exception as e:
+        logging.debug('Could not write audit log metrics: {}'.format(e))
 
 
 def main():
@@ -58,11 +330,7 @@ def main():
         return
 
     # identity = {'region': 'eu-west-1', 'accountId': 123456, 'instanceId': 'i-123'}
-    identity = boto.utils.get_instance_identity()['document']
-
-    region = identity['region']
-    account_id = identity['accountId']
-    instance_id = identity['instanceId']
+    identity = get_instance_identity()
 
     boot_time = get_boot_time()
 
@@ -70,15 +338,21 @@ def main():
     if len(sys.argv) > 1:
         is_shutdown = sys.argv[1] == '--shutdown'
 
+    queue = RetryQueue()
+    shipper = AuditLogShipper(config, identity, boot_time, queue)
+
+    if is_shutdown:
+        shipper.push_all(rotated_logs(), ignore_backoff=True)
+        for fn in glob.glob(CURRENT_AUDIT_LOG):
+            shipper.push_audit_log(fn, compress=True)
+        write_metrics(queue, rotated_logs())
+        return
+
     while True:
-        for fn in glob.glob('/var/log/audit.log.*.gz'):
-            push_audit_log(config, instance_logs_url, account_id, region, instance_id, boot_time, fn)
-        if is_shutdown:
-            for fn in glob.glob('/var/log/audit.log'):
-                push_audit_log(config, instance_logs_url, account_id, region, instance_id, boot_time, fn, compress=True)
-            return
-        rtime = random.randrange(60, 3000)
-        time.sleep(rtime)
+        shipper.push_all(rotated_logs())
+        write_metrics(queue, rotated_logs())
+        # spread the requests of all instances
+        time.sleep(random.uniform(POLL_MIN_SECONDS, POLL_MAX_SECONDS))
 
 
 if __name__ == '__main__':
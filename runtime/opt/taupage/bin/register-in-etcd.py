@@ -1,14 +1,26 @@
 #!/usr/bin/env python3
 
 import argparse
+import hashlib
 import json
 import logging
-import yaml
 import time
 import requests
 import socket
+import subprocess
+import threading
 
-from taupage import get_default_port
+from taupage import get_config, get_default_port
+from taupage.timeline import format_metric, write_textfile
+
+HEALTH_CHECK_TIMEOUT_SECONDS = 5
+DEFAULT_ETCD_URL = 'http://localhost:2379'
+ETCD_TIMEOUT_SECONDS = 2
+ETCD_FAILURE_BACKOFF_SECONDS = 30
+ETCD_PROBE_INTERVAL_SECONDS = 30
+ETCD_PROM_FILE = 'taupage_etcd_registration.prom'
+# refreshing the TTL without the value ("refresh=true") is only supported since etcd 2.3
+ETCD_REFRESH_MIN_VERSION = (2, 3)
 
 
 def get_first(iterable, default=None):
@@ -34,57 +46,459 @@ def get_health_check_url(config: dict):
     return url
 
 
-def is_healthy(url):
-    '''Return true if GET on the URL returns status 200'''
+class HealthProber(threading.Thread):
+    '''
+    Probes the application health in the background, independent of the heartbeats
+
+    The health state only flips after the configured number of consecutive
+    failed (or successful) probes, so single slow responses do not deregister.
+
+    >>> prober = HealthProber('http://localhost:1/health', interval=1, unhealthy_threshold=2, healthy_threshold=1)
+    >>> [prober.record(result) for result in (True, False, False, True)]
+    [True, True, False, True]
+    '''
+
+    def __init__(self, url, interval, unhealthy_threshold, healthy_threshold, timeout=HEALTH_CHECK_TIMEOUT_SECONDS):
+        super().__init__(daemon=True)
+        self.url = url
+        self.interval = interval
+        self.unhealthy_threshold = unhealthy_threshold
+        self.healthy_threshold = healthy_threshold
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.lock = threading.Lock()
+        self.healthy = False
+        self.consecutive_failures = 0
+        self.consecutive_successes = 0
+        self.last_latency = None
+
+    def probe(self):
+        '''Return true if GET on the URL returns status 200'''
+        start = time.monotonic()
+        try:
+            response = self.session.get(self.url, timeout=self.timeout)
+            return response.status_code == 200
+        except Exception:
+            return False
+        finally:
+            with self.lock:
+                self.last_latency = time.monotonic() - start
+
+    def record(self, result: bool):
+        with self.lock:
+            if result:
+                self.consecutive_failures = 0
+                self.consecutive_successes += 1
+                if not self.healthy and self.consecutive_successes >= self.healthy_threshold:
+                    logging.info('Application is healthy')
+                    self.healthy = True
+            else:
+                self.consecutive_successes = 0
+                self.consecutive_failures += 1
+                if self.healthy and self.consecutive_failures >= self.unhealthy_threshold:
+                    logging.warning('Application failed {} health checks, deregistering'.format(
+                                    self.consecutive_failures))
+                    self.healthy = False
+            return self.healthy
+
+    def run(self):
+        next_probe = time.monotonic()
+        while True:
+            self.record(self.probe())
+            next_probe += self.interval
+            time.sleep(max(0, next_probe - time.monotonic()))
+
+
+def write_metrics(prober: HealthProber, heartbeat_lag: float, registered: bool):
+    labels = {'hostname': socket.gethostname()}
+    metrics = [('taupage_etcd_heartbeat_lag_seconds', 'Time since the last successful heartbeat', heartbeat_lag),
+               ('taupage_etcd_registered', 'Whether the last heartbeat succeeded', int(registered))]
+    if prober:
+        with prober.lock:
+            metrics += [('taupage_etcd_health_probe_latency_seconds', 'Duration of the last health probe',
+                         prober.last_latency or 0),
+                        ('taupage_etcd_health_probe_consecutive_failures', 'Number of consecutive failed health probes',
+                         prober.consecutive_failures),
+                        ('taupage_etcd_application_healthy', 'Debounced health state of the application',
+                         int(prober.healthy))]
+    lines = []
+    for name, description, value in metrics:
+        lines += ['# HELP {} {}'.format(name, description),
+                  '# TYPE {} gauge'.format(name),
+                  format_metric(name, labels, value)]
     try:
-        response = requests.get(url, timeout=5)
-        if response.status_code == 200:
-            return True
-    except Exception:
-        return False
-    return False
+        write_textfile(ETCD_PROM_FILE, lines)
+    except Exception as e:
+        logging.debug('Could not write etcd registration metrics: {}'.format(e))
 
 
-def run_heartbeat(args):
-    with open(args.config) as fd:
-        config = yaml.load(fd)
+def get_metadata(config_file):
+    config = get_config(config_file)
 
     # for now, remove environment variables to not leak sensitive information accidentially
     config.pop("environment", None)
 
-    metadata = json.dumps(config)
+    return json.dumps(config, sort_keys=True)
+
+
+class EtcdError(Exception):
+    def __init__(self, status_code):
+        super().__init__('etcd returned HTTP status {}'.format(status_code))
+        self.status_code = status_code
+
+
+def parse_etcd_version(text):
+    '''
+    Parse the response of GET /version (plain text before etcd 2.1, JSON since), prefer the cluster version
+
+    >>> parse_etcd_version('etcd 2.0.11')
+    (2, 0, 11)
+    >>> parse_etcd_version('{"etcdserver":"2.3.7","etcdcluster":"2.3.0"}')
+    (2, 3, 0)
+    >>> parse_etcd_version('foo')
+    '''
+    try:
+        data = json.loads(text)
+        version = data.get('etcdcluster') or data.get('etcdserver') or ''
+    except ValueError:
+        version = text.strip().split()[-1] if text.strip() else ''
+    try:
+        return tuple(int(part) for part in version.split('.'))
+    except ValueError:
+        return None
+
+
+def parse_srv_records(output):
+    '''
+    Parse the output of "dig +short SRV" into client URLs, ordered by priority
+
+    >>> parse_srv_records('10 0 2379 etcd-2.example.org.\\n0 0 2379 etcd-1.example.org.\\n')
+    ['http://etcd-1.example.org:2379', 'http://etcd-2.example.org:2379']
+    '''
+    records = []
+    for line in output.splitlines():
+        parts = line.split()
+        if len(parts) == 4 and parts[0].isdigit():
+            priority, weight, port, target = parts
+            records.append((int(priority), 'http://{}:{}'.format(target.rstrip('.'), port)))
+    return [url for priority, url in sorted(records)]
+
+
+def parse_members(data):
+    '''
+    Return the client URLs of all members listed by GET /v2/members
+
+    >>> parse_members({'members': [{'clientURLs': ['http://10.0.0.1:2379/']}, {'name': 'new', 'clientURLs': []}]})
+    ['http://10.0.0.1:2379']
+    '''
+    return [url.rstrip('/') for member in data.get('members') or [] for url in member.get('clientURLs') or []]
+
+
+def discover_endpoints(domain):
+    '''
+    Look up etcd client URLs published as "_etcd-client._tcp" SRV records of a discovery domain
+
+    The etcd proxy itself bootstraps from the "_etcd-server._tcp" (peer) records, so these
+    might not exist: the client URLs of the members are also asked from the cluster.
+    '''
+    try:
+        output = subprocess.check_output(['dig', '+short', 'SRV', '_etcd-client._tcp.{}'.format(domain)],
+                                         timeout=ETCD_TIMEOUT_SECONDS)
+        return parse_srv_records(output.decode('utf-8'))
+    except Exception as e:
+        logging.warning('Could not discover etcd endpoints of {}: {}'.format(domain, e))
+        return []
+
+
+class EtcdEndpoint:
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self.session = requests.Session()
+        self.latency = None
+        self.failed_until = 0
+
+    def rank(self, now):
+        '''Healthy endpoints first, then the fastest (unknown latency last)'''
+        return (self.failed_until > now, self.latency is None, self.latency or 0)
+
+    def succeeded(self, latency):
+        # exponentially weighted, so a single slow request does not move all traffic
+        self.latency = latency if self.latency is None else 0.7 * self.latency + 0.3 * latency
+        self.failed_until = 0
+
+    def failed(self):
+        self.failed_until = time.monotonic() + ETCD_FAILURE_BACKOFF_SECONDS
+
+
+class EtcdCluster:
+    '''
+    Client for several etcd endpoints with one keep-alive session each
+
+    Requests go to the fastest healthy endpoint and fail over to the next one
+    on connection errors, timeouts and server errors, until the deadline of the
+    request (if any) has passed. All endpoints are probed in the background to
+    keep the latencies up to date.
+
+    >>> cluster = EtcdCluster(['http://a:2379', 'http://b:2379/'])
+    >>> cluster.endpoints[0].succeeded(0.5); cluster.endpoints[1].succeeded(0.1)
+    >>> [endpoint.url for endpoint in cluster.ranked()]
+    ['http://b:2379', 'http://a:2379']
+    >>> cluster.endpoints[1].failed()
+    >>> [endpoint.url for endpoint in cluster.ranked()]
+    ['http://a:2379', 'http://b:2379']
+    '''
+
+    def __init__(self, urls, timeout=ETCD_TIMEOUT_SECONDS, deadline=None):
+        self.endpoints = [EtcdEndpoint(url) for url in urls]
+        # the configured endpoints (e.g. the local proxy) are kept even if they are no members
+        self.configured = {endpoint.url for endpoint in self.endpoints}
+        self.timeout = timeout
+        self.deadline = deadline
+        self.lock = threading.Lock()
+        self.discover = False
+
+    def add(self, urls):
+        '''
+        Add endpoints not known yet
+
+        >>> cluster = EtcdCluster(['http://a:2379'])
+        >>> cluster.add(['http://a:2379/', 'http://b:2379'])
+        >>> [endpoint.url for endpoint in cluster.endpoints]
+        ['http://a:2379', 'http://b:2379']
+        '''
+        with self.lock:
+            known = {endpoint.url for endpoint in self.endpoints}
+            for url in urls:
+                if url.rstrip('/') not in known:
+                    self.endpoints.append(EtcdEndpoint(url))
+                    known.add(url.rstrip('/'))
+
+    def update_members(self, urls):
+        '''
+        Add the client URLs of the cluster members, remove discovered endpoints that are no members anymore
+
+        >>> cluster = EtcdCluster(['http://localhost:2379'])
+        >>> cluster.add(['http://a:2379', 'http://b:2379'])
+        >>> cluster.update_members(['http://b:2379', 'http://c:2379'])
+        >>> [endpoint.url for endpoint in cluster.endpoints]
+        ['http://localhost:2379', 'http://b:2379', 'http://c:2379']
+        '''
+        members = {url.rstrip('/') for url in urls}
+        if not members:
+            # nothing to compare with, rather keep what we have
+            return
+        with self.lock:
+            for endpoint in self.endpoints:
+                if endpoint.url not in members and endpoint.url not in self.configured:
+                    logging.info('etcd endpoint {} is no cluster member anymore'.format(endpoint.url))
+            self.endpoints = [endpoint for endpoint in self.endpoints
+                              if endpoint.url in members or endpoint.url in self.configured]
+        self.add(urls)
+
+    def discover_members(self):
+        '''Update the endpoints from the client URLs of all cluster members (e.g. asked through the local proxy)'''
+        self.discover = True
+        try:
+            response = self.request('GET', '/v2/members')
+            if response.status_code != 200:
+                raise EtcdError(response.status_code)
+            self.update_members(parse_members(response.json()))
+        except Exception as e:
+            logging.warning('Could not discover etcd cluster members: {}'.format(e))
+
+    def ranked(self):
+        now = time.monotonic()
+        with self.lock:
+            return sorted(self.endpoints, key=lambda endpoint: endpoint.rank(now))
+
+    def call(self, endpoint, method, path, timeout=None, **kwargs):
+        start = time.monotonic()
+        try:
+            response = endpoint.session.request(method, endpoint.url + path, timeout=timeout or self.timeout,
+                                                **kwargs)
+            if response.status_code >= 500:
+                raise EtcdError(response.status_code)
+        except Exception:
+            with self.lock:
+                endpoint.failed()
+            raise
+        with self.lock:
+            endpoint.succeeded(time.monotonic() - start)
+        return response
+
+    def remaining_timeout(self, remaining):
+        '''
+        Return the timeout (single value or connect and read timeout) limited to the remaining time
+
+        >>> EtcdCluster([], timeout=(1, 5)).remaining_timeout(2)
+        (1, 2)
+        >>> EtcdCluster([], timeout=2).remaining_timeout(0.5)
+        0.5
+        '''
+        if isinstance(self.timeout, tuple):
+            return tuple(min(timeout, remaining) for timeout in self.timeout)
+        return min(self.timeout, remaining)
+
+    def request(self, method, path, **kwargs):
+        end = time.monotonic() + self.deadline if self.deadline else None
+        last_error = None
+        for endpoint in self.ranked():
+            timeout = None
+            if end is not None:
+                remaining = end - time.monotonic()
+                if remaining <= 0:
+                    last_error = last_error or requests.exceptions.Timeout('etcd request deadline exceeded')
+                    break
+                timeout = self.remaining_timeout(remaining)
+            try:
+                return self.call(endpoint, method, path, timeout=timeout, **kwargs)
+            except Exception as e:
+                logging.warning('etcd endpoint {} failed: {}'.format(endpoint.url, e))
+                last_error = e
+        raise last_error
+
+    def probe(self):
+        for endpoint in list(self.endpoints):
+            try:
+                self.call(endpoint, 'GET', '/version')
+            except Exception as e:
+                logging.debug('etcd endpoint {} is not healthy: {}'.format(endpoint.url, e))
+
+    def start_probing(self, interval=ETCD_PROBE_INTERVAL_SECONDS):
+        def run():
+            while True:
+                self.probe()
+                time.sleep(interval)
+                if self.discover:
+                    # members might have been replaced in the meantime
+                    self.discover_members()
+        if len(self.endpoints) > 1 or self.discover:
+            threading.Thread(target=run, daemon=True).start()
+
+
+class EtcdRegistration:
+    '''
+    Registration of this host in etcd (v2 API) as /taupage/$hostname->$metadata
+
+    The metadata is only written when it changed (or the key expired),
+    heartbeats otherwise only refresh the TTL of the existing key. Older
+    etcd versions ignore the "refresh" flag and would overwrite the value
+    with an empty one, so they always get the value written again.
+    '''
+
+    def __init__(self, cluster: EtcdCluster, key, ttl):
+        self.cluster = cluster
+        self.path = "/v2/keys/{}".format(key)
+        self.key = key
+        self.ttl = ttl
+        self.written_hash = None
+        self.supports_refresh = None
+
+    def detect_refresh_support(self):
+        '''Check the etcd version once, return whether TTL refreshes are supported'''
+        if self.supports_refresh is None:
+            response = self.cluster.request('GET', '/version')
+            version = parse_etcd_version(response.text)
+            self.supports_refresh = version is not None and version >= ETCD_REFRESH_MIN_VERSION
+            logging.info('etcd version {}, refreshing TTL only: {}'.format(
+                '.'.join(str(part) for part in version) if version else 'unknown', self.supports_refresh))
+        return self.supports_refresh
+
+    def put(self, data):
+        response = self.cluster.request('PUT', self.path, data=data)
+        if response.status_code < 200 or response.status_code >= 300:
+            raise EtcdError(response.status_code)
+        return response
+
+    def write(self, value):
+        self.put({'value': value, 'ttl': self.ttl})
+        self.written_hash = hashlib.sha256(value.encode('utf-8')).hexdigest()
+
+    def refresh(self):
+        # refreshing the TTL neither changes the value nor notifies watchers
+        self.put({'ttl': self.ttl, 'refresh': 'true', 'prevExist': 'true'})
+
+    def heartbeat(self, value):
+        '''Send a heartbeat, return "write" or "refresh" depending on what was done'''
+        if self.written_hash == hashlib.sha256(value.encode('utf-8')).hexdigest() and self.detect_refresh_support():
+            try:
+                self.refresh()
+                return 'refresh'
+            except EtcdError as e:
+                if e.status_code != 404:
+                    raise
+                # key expired in the meantime
+        self.write(value)
+        return 'write'
+
+
+def run_heartbeat(args):
+    metadata = get_metadata(args.config)
     hostname = socket.gethostbyaddr(socket.gethostname())[0]
 
     logging.info("Sending heartbeat for me ({}) to etcd cluster {} every {} seconds with {} seconds tolerance..".format(
-                 hostname, args.etcd, args.interval, args.ttl))
+                 hostname, ', '.join(args.etcd), args.interval, args.ttl))
+
+    # support heartbeat checks to own application and only send to etcd if alive
+    health_check_url = get_health_check_url(json.loads(metadata))
+    prober = None
+    if health_check_url:
+        prober = HealthProber(health_check_url, args.health_interval or args.interval,
+                              args.unhealthy_threshold, args.healthy_threshold)
+        prober.start()
 
-    health_check_url = get_health_check_url(config)
+    urls = [url for value in args.etcd for url in value.split(',') if url]
+    # a heartbeat request must not take longer than the heartbeat interval, even when failing over
+    cluster = EtcdCluster(urls or [DEFAULT_ETCD_URL], timeout=(1, min(ETCD_TIMEOUT_SECONDS, args.interval)),
+                          deadline=args.interval)
+    discovery_domain = json.loads(metadata).get('etcd_discovery_domain')
+    if discovery_domain and discovery_domain != 'disable':
+        # the cluster members are used directly if the local proxy does not respond
+        cluster.add(discover_endpoints(discovery_domain))
+        cluster.discover_members()
+    cluster.start_probing()
+    registration = EtcdRegistration(cluster, "taupage/{}".format(hostname), args.ttl)
+    last_heartbeat = time.monotonic()
+    registered = False
+    next_heartbeat = time.monotonic()
 
     while True:
-        # support heartbeat checks to own application and only send to etcd if alive
-        if not health_check_url or is_healthy(health_check_url):
-            # push metadata as /taupage/$hostname->$metadata
-            key = "taupage/{}".format(hostname)
-            value = metadata
+        registered = False
+        if not prober or prober.healthy:
+            try:
+                # config is only parsed again if the file changed
+                action = registration.heartbeat(get_metadata(args.config))
+                last_heartbeat = time.monotonic()
+                registered = True
+                if args.logging:
+                    logging.info("Heartbeat ({}): {} ttl={}".format(action, registration.key, args.ttl))
+            except Exception as e:
+                logging.warn("Could not send heartbeat to etcd cluster: {}".format(e))
 
-            data = {'value': value, 'ttl': args.ttl}
-            response = requests.put("{}/v2/keys/{}".format(args.etcd, key), data=data, stream=False)
-            if response.status_code < 200 or response.status_code >= 300:
-                logging.warn("Could not send heartbeat to etcd cluster {}: {}".format(args.etcd, response.status_code))
-            elif args.logging:
-                logging.info("Heartbeat: {} ttl={}".format(key, args.ttl))
+        write_metrics(prober, time.monotonic() - last_heartbeat, registered)
 
-        time.sleep(args.interval)
+        # fixed schedule: a slow heartbeat does not delay the following ones
+        next_heartbeat += args.interval
+        time.sleep(max(0, next_heartbeat - time.monotonic()))
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-c', '--config', help="configuration file to publish (yaml)", default="/meta/taupage.yaml")
-    parser.add_argument('-e', '--etcd', help="in which etcd to register", default="http://localhost:2379")
-    parser.add_argument('-i', '--interval', help='heartbeat interval', default=5)
-    parser.add_argument('-t', '--ttl', help='heartbead ttl', default=15)
+    parser.add_argument('-e', '--etcd', action='append',
+                        help="in which etcd to register (several endpoints can be given comma separated or by "
+                             "repeating the option, default: {})".format(DEFAULT_ETCD_URL))
+    parser.add_argument('-i', '--interval', help='heartbeat interval', type=float, default=5)
+    parser.add_argument('-t', '--ttl', help='heartbead ttl', type=int, default=15)
     parser.add_argument('-l', '--logging', help="log heartbeats?", default=False)
+    parser.add_argument('--health-interval', type=float,
+                        help='health check interval (default: heartbeat interval)')
+    parser.add_argument('--unhealthy-threshold', type=int, default=3,
+                        help='number of failed health checks until deregistering')
+    parser.add_argument('--healthy-threshold', type=int, default=1,
+                        help='number of successful health checks until registering (again)')
     args = parser.parse_args()
+    args.etcd = args.etcd or [DEFAULT_ETCD_URL]
 
     logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
     logging.getLogger("urllib3.connectionpool").setLevel(logging.WARN)
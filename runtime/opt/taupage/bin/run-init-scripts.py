@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+'''
+Run all init.d scripts, executing independent scripts in parallel
+
+A script can declare the scripts it depends on with a header comment
+in its first lines, e.g.:
+
+    # depends-on: 00-create-custom-routing.py 02-prepare-td-agent.sh
+
+An empty "depends-on:" header means the script has no dependencies at all.
+Scripts without such a header keep the old sequential semantics: they only
+start after all scripts sorted before them have finished.
+'''
+
+import argparse
+import logging
+import os
+import re
+import subprocess
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from taupage import configure_logging
+from taupage.timeline import record_step
+
+DEPENDS_ON_PATTERN = re.compile(r'^#\s*depends-on:(.*)$')
+HEADER_LINES = 20
+
+
+def parse_dependencies(lines):
+    '''
+    Return the declared dependencies from the header lines of an init script
+    or None if the script does not declare any
+
+    >>> parse_dependencies(['#!/bin/bash', 'echo foo'])
+
+    >>> parse_dependencies(['#!/bin/bash', '# depends-on:'])
+    []
+
+    >>> parse_dependencies(['#!/bin/bash', '# depends-on: 00-a.sh  01-b.py'])
+    ['00-a.sh', '01-b.py']
+    '''
+    for line in lines:
+        match = DEPENDS_ON_PATTERN.match(line.strip())
+        if match:
+            return match.group(1).split()
+    return None
+
+
+def read_dependencies(path):
+    try:
+        with open(path, errors='replace') as fd:
+            lines = [fd.readline() for i in range(HEADER_LINES)]
+    except OSError:
+        return None
+    return parse_dependencies(lines)
+
+
+def resolve_dependencies(scripts: list, declared: dict):
+    '''
+    Build the dependency graph for the given (sorted) script names
+
+    >>> graph = resolve_dependencies(['a', 'b', 'c', 'd'], {'b': [], 'c': ['a']})
+    >>> sorted(graph['a']), sorted(graph['b']), sorted(graph['c']), sorted(graph['d'])
+    ([], [], ['a'], ['a', 'b', 'c'])
+
+    >>> resolve_dependencies(['a', 'b'], {'b': ['x']})
+    Traceback (most recent call last):
+    ...
+    ValueError: b depends on unknown script x
+
+    >>> resolve_dependencies(['a', 'b'], {'a': ['b'], 'b': ['a']})
+    Traceback (most recent call last):
+    ...
+    ValueError: Circular dependency between init scripts: a, b
+    '''
+    graph = {}
+    for i, script in enumerate(scripts):
+        deps = declared.get(script)
+        if deps is None:
+            # no declared dependencies: run after everything sorted before
+            graph[script] = set(scripts[:i])
+        else:
+            for dep in deps:
+                if dep not in scripts:
+                    raise ValueError('{} depends on unknown script {}'.format(script, dep))
+            graph[script] = set(deps)
+
+    # make sure there is a valid execution order
+    done = set()
+    remaining = set(scripts)
+    while remaining:
+        ready = {script for script in remaining if graph[script] <= done}
+        if not ready:
+            raise ValueError('Circular dependency between init scripts: {}'.format(', '.join(sorted(remaining))))
+        done |= ready
+        remaining -= ready
+    return graph
+
+
+def run_script(path):
+    start = time.time()
+    cpu_seconds = 0
+    try:
+        proc = subprocess.Popen([path])
+        # wait4() gives us the resource usage of exactly this script
+        _, status, rusage = os.wait4(proc.pid, 0)
+        cpu_seconds = rusage.ru_utime + rusage.ru_stime
+        if os.WIFSIGNALED(status):
+            exit_code = 128 + os.WTERMSIG(status)
+        else:
+            exit_code = os.WEXITSTATUS(status)
+        proc.returncode = exit_code
+    except OSError as e:
+        logging.error('Could not execute %s: %s', path, e)
+        exit_code = 126
+    end = time.time()
+    record_step(os.path.basename(path), start, end, exit_code, cpu_seconds, source='init.d')
+    return exit_code, end - start
+
+
+def run_scripts(directory, jobs):
+    '''Run all scripts, return the first failed script (or None)'''
+    scripts = sorted(os.listdir(directory))
+    declared = {script: read_dependencies(os.path.join(directory, script)) for script in scripts}
+    graph = resolve_dependencies(scripts, declared)
+
+    pending = list(scripts)
+    done = set()
+    running = {}
+    failed = None
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while pending or running:
+            # fail-fast: do not start any new scripts after the first failure
+            if not failed:
+                for script in [s for s in pending if graph[s] <= done]:
+                    if len(running) >= jobs:
+                        break
+                    pending.remove(script)
+                    path = os.path.join(directory, script)
+                    running[executor.submit(run_script, path)] = path
+
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                path = running.pop(future)
+                exit_code, elapsed = future.result()
+                if exit_code != 0:
+                    logging.error('%s did not successfully finish', path)
+                    failed = failed or path
+                else:
+                    logging.info('%s finished in %.1f seconds', path, elapsed)
+                    done.add(os.path.basename(path))
+
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs all init scripts of a directory respecting their dependencies')
+    parser.add_argument('directory', help='directory containing the init scripts')
+    parser.add_argument('-j', '--jobs', type=int, default=4, help='maximum number of scripts to run in parallel')
+    args = parser.parse_args()
+
+    configure_logging()
+
+    try:
+        failed = run_scripts(args.directory, max(args.jobs, 1))
+    except ValueError as e:
+        logging.error('Invalid init script dependencies: %s', e)
+        sys.exit(1)
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
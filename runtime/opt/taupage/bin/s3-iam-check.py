@@ -1,11 +1,12 @@
 #!/usr/bin/env python3
 
 import logging
-import boto.utils
 import boto3
 import time
 import click
 
+from taupage import get_instance_id, get_metadata
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -20,10 +21,10 @@ def cli(ctx):
 @click.argument('bucketname', type=str)
 @click.pass_context
 def test(ctx, bucketname):
-    hostname = boto.utils.get_instance_metadata()['local-hostname'].split('.')[0]
+    hostname = get_metadata('local-hostname').split('.')[0]
     test_get_object = True
     s3_iam_error = 0
-    inst_id = boto.utils.get_instance_identity()['document']['instanceId']
+    inst_id = get_instance_id()
     ts = int(time.time())
     key = 'iamtest/{!s}'.format(inst_id)
     testobject = boto3.resource('s3').Object(bucketname, key)
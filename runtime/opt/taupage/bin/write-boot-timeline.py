@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+'''
+Export the boot timeline of the Taupage init process as JSON and Prometheus textfile
+'''
+
+import argparse
+import logging
+
+from taupage import configure_logging
+from taupage.timeline import export_timeline, TIMELINE_JSON_FILE, TIMELINE_PROM_FILE
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Exports the boot timeline collected during Taupage init')
+    parser.add_argument('--boot-start', type=float, required=True, help='UNIX timestamp of the Taupage boot')
+    parser.add_argument('--exit-code', type=int, default=0, help='exit code of the init process')
+    args = parser.parse_args()
+
+    configure_logging()
+
+    try:
+        export_timeline(args.boot_start, args.exit_code)
+        logging.info('Boot timeline written to %s and %s', TIMELINE_JSON_FILE, TIMELINE_PROM_FILE)
+    except Exception:
+        # the timeline is informational only, never fail the boot for it
+        logging.exception('Failed to export boot timeline')
+
+
+if __name__ == '__main__':
+    main()
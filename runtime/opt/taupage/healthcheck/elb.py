@@ -1,52 +1,292 @@
 #!/usr/bin/env python3
 
+import json
+import os
+import socket
 import sys
 import logging
-from boto.utils import get_instance_identity
-from taupage import configure_logging, get_config
-from time import sleep
+import random
+import time
+import boto.exception
+import boto3
+import botocore.exceptions
+from concurrent.futures import ThreadPoolExecutor
+from taupage import atomic_write, configure_logging, get_config, get_instance_id, get_region, get_availability_zone, \
+    get_metadata
+from taupage.timeline import TIMELINE_FILE, format_metric, record_step, write_textfile
+from time import monotonic, sleep
 from boto.ec2 import elb
 
+THROTTLING_ERRORS = ('Throttling', 'ThrottlingException', 'RequestLimitExceeded')
+
+CLASSIC_ELB = 'elb'
+TARGET_GROUP = 'target-group'
+
+HEALTH_CHECK_JSON_FILE = os.path.join(os.path.dirname(TIMELINE_FILE), 'elb-health-check.json')
+HEALTH_CHECK_PROM_FILE = 'taupage_elb_health_check.prom'
+
+
+def is_throttling(e: Exception):
+    '''
+    >>> is_throttling(ValueError())
+    False
+    '''
+    if isinstance(e, boto.exception.BotoServerError):
+        return str(e.error_code) in THROTTLING_ERRORS
+    if isinstance(e, botocore.exceptions.ClientError):
+        return e.response.get('Error', {}).get('Code') in THROTTLING_ERRORS
+    return False
+
+
+def get_targets(healthcheck: dict):
+    '''
+    Return the load balancers (classic ELBs and target groups) of the healthcheck section
+
+    >>> get_targets({'loadbalancer_name': 'foo-elb'})
+    [('elb', 'foo-elb')]
+
+    >>> get_targets({'loadbalancer_name': ['a', 'b'], 'target_group_arns': ['arn:tg']})
+    [('elb', 'a'), ('elb', 'b'), ('target-group', 'arn:tg')]
+    '''
+    def as_list(value):
+        if not value:
+            return []
+        return [value] if isinstance(value, str) else list(value)
+
+    names = as_list(healthcheck.get('loadbalancer_name')) + as_list(healthcheck.get('loadbalancer_names'))
+    arns = as_list(healthcheck.get('target_group_arn')) + as_list(healthcheck.get('target_group_arns'))
+    return [(CLASSIC_ELB, name) for name in names] + [(TARGET_GROUP, arn) for arn in arns]
+
 
 class ElbHealthChecker(object):
+    # maximum time between two polls, polling starts with MIN_INTERVAL and backs off
     INTERVAL = 10
+    MIN_INTERVAL = 0.5
     TIMEOUT = 300
 
     def __init__(self, region):
         configure_logging()
         self.logger = logging.getLogger(__name__)
+        self.region = region
         self.elb_client = elb.connect_to_region(region)
+        self._elbv2_client = None
+        self.reset_report()
 
-    def _get_elb_instance_state(self, instance_id: str, elb_name: str):
+    def reset_report(self):
+        self.started = None
+        self.finished = None
+        self.states = {}
+        self.transitions = []
+        self.polls = {}
+        self.in_service_at = {}
+
+    def observe(self, target: tuple, state: str, reason: str):
+        '''
+        Count a poll and record a state transition of a target
+
+        >>> checker = ElbHealthChecker.__new__(ElbHealthChecker)
+        >>> checker.reset_report(); checker.logger = logging.getLogger(__name__); checker.started = 100
+        >>> for state in ('OutOfService', 'OutOfService', 'InService'):
+        ...     checker.observe(('elb', 'foo'), state, 'ELB')
+        >>> [(t['from'], t['to']) for t in checker.transitions], checker.polls[('elb', 'foo')]
+        ([(None, 'OutOfService'), ('OutOfService', 'InService')], 3)
+        '''
+        now = time.time()
+        self.polls[target] = self.polls.get(target, 0) + 1
+        previous = self.states.get(target)
+        if state != previous:
+            self.logger.info("{} {}: {} -> {} ({})".format(target[0], target[1], previous, state, reason))
+            self.transitions.append({'kind': target[0], 'target': target[1], 'time': round(now, 3),
+                                     'elapsed': round(now - self.started, 3),
+                                     'from': previous, 'to': state, 'reason': reason})
+            self.states[target] = state
+        if state == 'InService':
+            self.in_service_at.setdefault(target, now)
+
+    @property
+    def elbv2_client(self):
+        # boto3 clients are thread-safe, so all target groups share one
+        if self._elbv2_client is None:
+            self._elbv2_client = boto3.client('elbv2', region_name=self.region)
+        return self._elbv2_client
+
+    def _get_elb_instance_health(self, instance_id: str, elb_name: str):
+        '''Return state and reason code of the instance in a classic ELB'''
         result = self.elb_client.describe_instance_health(load_balancer_name=elb_name,
                                                           instances=[instance_id])
         state = result[0].state
         self.logger.debug("ELB state for instance {0}: {1}".format(instance_id, state))
-        return state
+        return state, getattr(result[0], 'reason_code', None)
 
-    def is_in_service_from_elb_perspective(self, instance_id: str, elb_name: str):
-        for i in range(0, max(int(self.TIMEOUT / self.INTERVAL), 1)):
-            state = self._get_elb_instance_state(instance_id, elb_name)
-            if state == 'InService':
+    def _get_elb_instance_state(self, instance_id: str, elb_name: str):
+        return self._get_elb_instance_health(instance_id, elb_name)[0]
+
+    def _get_target_group_health(self, instance_id: str, target_group_arn: str):
+        '''Return state ("InService" if healthy on all ports) and reason code of the instance in a target group'''
+        result = self.elbv2_client.describe_target_health(TargetGroupArn=target_group_arn,
+                                                          Targets=[{'Id': instance_id}])
+        descriptions = result.get('TargetHealthDescriptions') or []
+        if not descriptions:
+            # never report an instance in service that is not registered at all
+            return 'unused', 'Target.NotRegistered'
+        for description in descriptions:
+            health = description.get('TargetHealth', {})
+            if health.get('State') != 'healthy':
+                return health.get('State'), health.get('Reason')
+        return 'InService', None
+
+    def get_health(self, instance_id: str, target: tuple):
+        kind, name = target
+        if kind == TARGET_GROUP:
+            return self._get_target_group_health(instance_id, name)
+        return self._get_elb_instance_health(instance_id, name)
+
+    def poll(self, instance_id: str, targets: list):
+        '''
+        Poll all targets, return a dict target -> (state, reason code) and whether requests were throttled
+
+        Target groups are polled concurrently, classic ELBs one after the other
+        (boto's connection is not thread-safe).
+        '''
+        results = {}
+        throttled = False
+
+        def poll_target(target):
+            try:
+                return self.get_health(instance_id, target)
+            except Exception as e:
+                if not is_throttling(e):
+                    raise
+                return None
+
+        target_groups = [target for target in targets if target[0] == TARGET_GROUP]
+        with ThreadPoolExecutor(max_workers=max(len(target_groups), 1)) as executor:
+            futures = {target: executor.submit(poll_target, target) for target in target_groups}
+            for target in targets:
+                if target[0] != TARGET_GROUP:
+                    results[target] = poll_target(target)
+            for target, future in futures.items():
+                results[target] = future.result()
+
+        for target in list(results):
+            if results[target] is None:
+                throttled = True
+                del results[target]
+        return results, throttled
+
+    def next_interval(self, interval: float, throttled: bool = False):
+        '''
+        Back off exponentially (faster when throttled) up to INTERVAL
+
+        >>> checker = ElbHealthChecker.__new__(ElbHealthChecker)
+        >>> checker.next_interval(0.5), checker.next_interval(8), checker.next_interval(0.5, throttled=True)
+        (1.0, 10, 2.0)
+        '''
+        return min(self.INTERVAL, interval * (4 if throttled else 2))
+
+    def are_in_service(self, instance_id: str, targets: list):
+        '''Wait until the instance is in service in all targets, return False if the timeout expired'''
+        deadline = monotonic() + self.TIMEOUT
+        self.reset_report()
+        self.started = time.time()
+        pending = list(targets)
+        for target in targets:
+            self.polls[target] = 0
+        interval = self.MIN_INTERVAL
+        while True:
+            results, throttled = self.poll(instance_id, pending)
+            for target, (state, reason) in sorted(results.items()):
+                self.observe(target, state, reason)
+                if state == 'InService':
+                    self.logger.info("instance in service in {} {}".format(*target))
+                    pending.remove(target)
+                else:
+                    self.logger.debug('waiting for instance in {} {}: {} ({})'.format(
+                                      target[0], target[1], state, reason))
+            if not pending:
                 self.logger.info("instance in service")
+                self.finished = time.time()
                 return True
-            else:
-                self.logger.debug('waiting for instance')
-                sleep(self.INTERVAL)
+            if throttled:
+                self.logger.info('Throttling AWS API requests...')
+
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                break
+            # jitter, so instances started together do not poll in lockstep
+            sleep(min(remaining, interval * random.uniform(0.8, 1.2)))
+            interval = self.next_interval(interval, throttled)
 
-        self.logger.warning("timeout for in-service check exceeded")
+        self.logger.warning("timeout for in-service check exceeded, not in service in: {}".format(
+                            ', '.join('{} {}'.format(*target) for target in pending)))
+        self.finished = time.time()
         return False
 
+    def write_report(self, labels: dict = None):
+        '''
+        Export the observed state transitions as JSON and time to InService
+        and poll counts per target as Prometheus textfile and boot steps,
+        never fails (labels are looked up if not given)
+        '''
+        try:
+            if labels is None:
+                labels = {'hostname': socket.gethostname(),
+                          'availability_zone': get_availability_zone(),
+                          'instance_type': get_metadata('instance-type')}
+            # not set if polling failed
+            finished = self.finished or time.time()
+            report = {'started': self.started, 'finished': finished, 'labels': labels, 'targets': [],
+                      'transitions': self.transitions}
+            lines = []
+            metrics = [('taupage_elb_time_to_in_service_seconds',
+                        'Time until the instance was in service (-1 if it never was)'),
+                       ('taupage_elb_health_polls', 'Number of health polls'),
+                       ('taupage_elb_state_transitions', 'Number of observed state transitions')]
+            values = {name: [] for name, description in metrics}
+            for target in sorted(self.polls):
+                in_service_at = self.in_service_at.get(target)
+                time_to_in_service = round(in_service_at - self.started, 3) if in_service_at else -1
+                transitions = len([t for t in self.transitions if (t['kind'], t['target']) == target])
+                report['targets'].append({'kind': target[0], 'target': target[1], 'polls': self.polls[target],
+                                          'state': self.states.get(target), 'time_to_in_service': time_to_in_service})
+                target_labels = dict(labels, kind=target[0], target=target[1])
+                values['taupage_elb_time_to_in_service_seconds'].append(
+                    format_metric('taupage_elb_time_to_in_service_seconds', target_labels, time_to_in_service))
+                values['taupage_elb_health_polls'].append(
+                    format_metric('taupage_elb_health_polls', target_labels, self.polls[target]))
+                values['taupage_elb_state_transitions'].append(
+                    format_metric('taupage_elb_state_transitions', target_labels, transitions))
+                record_step('elb_in_service', self.started, in_service_at or finished,
+                            0 if in_service_at else 1, 0, target=target[1])
+
+            for name, description in metrics:
+                lines += ['# HELP {} {}'.format(name, description), '# TYPE {} gauge'.format(name)] + values[name]
+
+            atomic_write(HEALTH_CHECK_JSON_FILE, json.dumps(report, indent=2, sort_keys=True), mode=0o644)
+            write_textfile(HEALTH_CHECK_PROM_FILE, lines)
+        except Exception as e:
+            self.logger.warning('Could not write health check report: {}'.format(e))
+
+    def is_in_service_from_elb_perspective(self, instance_id: str, elb_name: str):
+        return self.are_in_service(instance_id, [(CLASSIC_ELB, elb_name)])
+
 
 if __name__ == '__main__':
-    region = get_instance_identity()['document']['region']
-    instance_id = get_instance_identity()['document']['instanceId']
+    region = get_region()
+    instance_id = get_instance_id()
 
     config = get_config()
-    loadbalancer_name = config['healthcheck']['loadbalancer_name']
+    targets = get_targets(config['healthcheck'])
+    if not targets:
+        logging.error('No load balancer or target group configured for the health check')
+        sys.exit(1)
 
     healthchecker = ElbHealthChecker(region)
-    is_in_service = healthchecker.is_in_service_from_elb_perspective(instance_id, loadbalancer_name)
+    try:
+        is_in_service = healthchecker.are_in_service(instance_id, targets)
+    finally:
+        # also report what was observed until polling failed
+        healthchecker.write_report()
 
     if is_in_service:
         sys.exit(0)
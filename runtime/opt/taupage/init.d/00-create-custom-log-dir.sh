@@ -1,4 +1,5 @@
 #!/bin/bash
+# depends-on:
 
 #just create custom log directory
 if [ ! -d /var/log-custom ]
@@ -1,11 +1,12 @@
 #!/usr/bin/env python3
+# depends-on:
 
 import logging
 import requests
 import sys
 import subprocess
 
-from taupage import configure_logging, get_config
+from taupage import configure_logging, get_config, get_metadata, get_region
 
 
 def subprocess_call(args):
@@ -31,17 +32,12 @@ def main():
     if not nat_gateways or not isinstance(nat_gateways, dict):  # nat gateways must be non empty dictionary
         sys.exit(0)
 
-    METADATA_URL = 'http://169.254.169.254/latest/meta-data/'
     try:
-        r = requests.get(METADATA_URL + 'placement/availability-zone')
-        region = r.text.strip()[:-1]
+        region = get_region()
         logging.info('Region=%s', region)
 
-        r = requests.get(METADATA_URL + 'mac')
-        mac = r.text.strip()
-
-        r = requests.get(METADATA_URL + 'network/interfaces/macs/' + mac + '/subnet-id')
-        subnet = r.text
+        mac = get_metadata('mac').strip()
+        subnet = get_metadata('network/interfaces/macs/' + mac + '/subnet-id')
         if subnet not in nat_gateways:
             logging.warning('Can not find subnet %s in the nat_gateways mapping', subnet)
             sys.exit(0)
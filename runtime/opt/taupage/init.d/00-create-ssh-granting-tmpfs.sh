@@ -1,4 +1,5 @@
 #!/bin/bash
+# depends-on:
 # This script is supposed to serve a backup solution if the filesystem
 # is full. It should provide the option for the user to ssh as root.
 
@@ -1,15 +1,13 @@
 #!/usr/bin/env python3
-import base64
+# depends-on: 00-create-custom-routing.py 00-create-custom-log-dir.sh
 import json
 import logging
 import subprocess
 import sys
 
-import boto.utils
-import boto3
-import requests
 import yaml
-from taupage import get_config
+from taupage import get_config, get_instance_identity, get_metadata
+from taupage.kms import decrypt_ciphertexts
 
 FAKE_CI_ACCOUNT_KEY = "foo1234"
 
@@ -91,14 +89,12 @@ def decrypt_scalyr_key():
     if not account_key.startswith(key_prefix):
         return account_key
 
-    region_name = requests.get('http://169.254.169.254/latest/meta-data/placement/availability-zone').text[:-1]
-    client = boto3.client(service_name='kms', region_name=region_name)
-    response = client.decrypt(CiphertextBlob=base64.b64decode(account_key[len(key_prefix):]))
-    return response['Plaintext'].decode()
+    ciphertext = account_key[len(key_prefix):].lstrip(':')
+    return decrypt_ciphertexts([ciphertext])[ciphertext]
 
 
 def create_config_skeleton():
-    instance_data = boto.utils.get_instance_identity()['document']
+    instance_data = get_instance_identity()
 
     server_attributes = {
         'application_id': main_config.get('application_id'),
@@ -109,7 +105,7 @@ def create_config_skeleton():
         'image': main_config.get('source', '').split(':', 1)[0] or None,
         'aws_region': instance_data.get('region'),
         'aws_account': instance_data.get('accountId'),
-        'aws_ec2_hostname': boto.utils.get_instance_metadata()['local-hostname'],
+        'aws_ec2_hostname': get_metadata('local-hostname'),
         'aws_ec2_instance_id': instance_data.get('instanceId')
     }
 
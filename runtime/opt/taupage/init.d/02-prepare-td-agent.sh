@@ -1,4 +1,5 @@
 #!/bin/bash
+# depends-on:
 
 # Ensure that directories are writable
 mkdir -p -m0755 /var/run/td-agent
\ No newline at end of file
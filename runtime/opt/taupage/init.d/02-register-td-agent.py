@@ -1,12 +1,13 @@
 #!/usr/bin/env python3
+# depends-on: 00-create-custom-routing.py 00-create-custom-log-dir.sh 02-prepare-td-agent.sh
 
 import logging
 import subprocess
 import re
-import boto.utils
 
 from jinja2 import Environment, FileSystemLoader
-from taupage import get_config
+from taupage import get_config, get_instance_identity, get_metadata
+from taupage.kms import decrypt_ciphertexts
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -34,17 +35,15 @@ def get_scalyr_api_key():
         # If scalyr_api_key starts with "aws:kms:" then decrypt key
         match_kms_key = re.search('aws:kms:', scalyr_api_key, re.IGNORECASE)
         if match_kms_key:
-            scalyr_api_key = re.sub(r'aws:kms:', '', scalyr_api_key)
+            ciphertext = re.sub(r'aws:kms:', '', scalyr_api_key)
             try:
-                scalyr_api_key = subprocess.check_output(['python3',
-                                                          '/opt/taupage/bin/decrypt-kms.py',
-                                                          scalyr_api_key]).decode('UTF-8').strip()
+                scalyr_api_key = decrypt_ciphertexts([ciphertext])[ciphertext]
+            except ValueError:
+                logger.error('Failed to decrypt KMS Key')
+                raise SystemExit(1)
             except Exception:
-                logger.error('Failed to run /opt/taupage/bin/decrypt-kms.py')
+                logger.exception('Failed to decrypt Scalyr API key')
                 raise SystemExit()
-        if scalyr_api_key == "Invalid KMS key.":
-            logger.error('Failed to decrypt KMS Key')
-            raise SystemExit(1)
         return scalyr_api_key
 
 
@@ -58,10 +57,10 @@ def update_configuration_from_template(s3_default):
     stack = config.get('notify_cfn', {}).get('stack')
     source = config.get('source')
     image = config.get('source').split(':', 1)[0]
-    instance_data = boto.utils.get_instance_identity()['document']
+    instance_data = get_instance_identity()
     aws_region = instance_data['region']
     aws_account = instance_data['accountId']
-    hostname = boto.utils.get_instance_metadata()['local-hostname'].split('.')[0]
+    hostname = get_metadata('local-hostname').split('.')[0]
     customlog = config.get('mount_custom_log')
     if config.get('rsyslog_aws_metadata'):
         scalyr_syslog_log_parser = 'systemLogMetadata'
@@ -155,7 +154,7 @@ def update_configuration_from_template(s3_default):
 
 
 if __name__ == '__main__':
-    hostname = boto.utils.get_instance_metadata()['local-hostname'].split('.')[0]
+    hostname = get_metadata('local-hostname').split('.')[0]
     config = get_config()
     logging_config = config.get('logging')
     s3_default = False
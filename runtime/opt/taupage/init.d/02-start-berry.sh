@@ -1,4 +1,5 @@
 #!/bin/bash
+# depends-on: 00-create-custom-routing.py
 
 # only start berry service if "mint_bucket" was defined
 grep 'mint_bucket' /meta/taupage.yaml
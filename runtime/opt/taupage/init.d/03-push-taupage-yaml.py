@@ -1,13 +1,13 @@
 #!/usr/bin/env python3
+# depends-on: 00-create-custom-routing.py
 
-import boto.utils
 import codecs
 import json
 import logging
 import requests
 import yaml
 
-from taupage import configure_logging, get_config, mask_dictionary, get_boot_time
+from taupage import configure_logging, get_config, mask_dictionary, get_boot_time, get_instance_identity
 from base64 import b64encode
 
 
@@ -24,7 +24,7 @@ def main():
                 encoding='ascii')).decode("ascii") or ''
 
         # identity = {'region': 'eu-west-1', 'accountId': 123456, 'instanceId': 'i-123'}
-        identity = boto.utils.get_instance_identity()['document']
+        identity = get_instance_identity()
 
         region = identity['region']
         account_id = identity['accountId']
@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
+# depends-on: 00-create-custom-routing.py
 
-import boto.utils
 import logging
 import os
 import sys
@@ -8,7 +8,7 @@ import textwrap
 import subprocess
 
 from jinja2 import Template
-from taupage import configure_logging, get_config
+from taupage import configure_logging, get_config, get_instance_identity
 
 AWS_CONFIG_TEMPLATE = textwrap.dedent("""
     [plugins]
@@ -85,7 +85,7 @@ def main():
     logging.info('Configuring Cloudwatch Logs Agent')
 
     # identity = {'region': 'eu-west-1', 'accountId': 123456, 'instanceId': 'i-123'}
-    identity = boto.utils.get_instance_identity()['document']
+    identity = get_instance_identity()
 
     environment = {
         'observed_log_files': config.get('cloudwatch_logs'),
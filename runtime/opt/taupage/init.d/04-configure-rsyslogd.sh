@@ -1,4 +1,5 @@
 #!/bin/bash
+# depends-on:
 
 eval $(/opt/taupage/bin/parse-yaml.py /meta/taupage.yaml "config")
 
@@ -1,4 +1,5 @@
 #!/bin/sh
+# depends-on:
 
 eval $(/opt/taupage/bin/parse-yaml.py /meta/taupage.yaml "config")
 
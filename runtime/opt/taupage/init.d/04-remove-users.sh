@@ -1,4 +1,5 @@
 #!/bin/sh
+# depends-on: 00-create-ssh-granting-tmpfs.sh
 
 # Read metadata (if test_instance: true then keep ubuntu user)
 eval $(/opt/taupage/bin/parse-yaml.py /meta/taupage.yaml "config")
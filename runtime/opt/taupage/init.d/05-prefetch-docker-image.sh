@@ -0,0 +1,18 @@
+#!/bin/bash
+# depends-on: 00-create-custom-routing.py 05-configure-docker.py
+# start pulling the Docker image while the other init scripts are running,
+# the Docker runtime waits for the prefetch to finish
+
+PREFETCH_LOCK_FILE=/run/taupage/image-prefetch.lock
+
+eval $(/opt/taupage/bin/parse-yaml.py /meta/taupage.yaml "config")
+
+if [ "$(basename "$config_runtime")" = "Docker" ]; then
+    # take the lock before the prefetch is started in the background: the runtime
+    # can not run before it, the lock is released when the prefetch (inheriting fd 9) exits
+    mkdir -p -m 700 "$(dirname "$PREFETCH_LOCK_FILE")"
+    exec 9> "$PREFETCH_LOCK_FILE"
+    flock -x 9
+    # do not keep the output of the init process open
+    (/opt/taupage/runtime/Docker.py --prefetch 2>&1 | logger -t taupage-prefetch) > /dev/null 2>&1 &
+fi
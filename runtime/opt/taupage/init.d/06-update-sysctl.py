@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
+# depends-on:
 
 import logging
 import sys
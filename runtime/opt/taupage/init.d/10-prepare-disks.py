@@ -1,42 +1,47 @@
 #!/usr/bin/env python3
+# depends-on: 00-create-custom-routing.py
 
 import argparse
+import glob
+import json
 import logging
 import string
 import sys
 import subprocess
 import os
 import pwd
+import threading
 import time
 
 import boto.ec2
-import boto.utils
 
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from time import sleep
-from taupage import configure_logging, get_config
+from taupage import atomic_write, configure_logging, get_config, get_metadata, get_availability_zone, get_instance_id, \
+    get_region
+from taupage.timeline import boot_phase, run_command
 
 
 def instance_id():
     """Helper to return theid for the current instance"""
-    return boto.utils.get_instance_metadata()['instance-id']
+    return get_instance_id()
 
 
 def detect_region():
     """Helper to return the region for the current instance"""
-    return boto.utils.get_instance_metadata()['placement']['availability-zone'][:-1]
+    return get_region()
 
 
 def zone():
     """Helper to return the AZ for the current instance"""
-    return boto.utils.get_instance_metadata()['placement']['availability-zone']
+    return get_availability_zone()
 
 
 def allowed_volume_name_subs():
     """Helper to return the allowed volume name substitutions from the instance metadata"""
-    metadata = boto.utils.get_instance_metadata()
     return {
-        'local_ipv4':  metadata.get('local-ipv4'),
-        'public_ipv4': metadata.get('public-ipv4')
+        'local_ipv4':  get_metadata('local-ipv4'),
+        'public_ipv4': get_metadata('public-ipv4')
     }
 
 
@@ -70,63 +75,97 @@ def attach_volume(ec2, volume_id, attach_as):
     ec2.attach_volume(volume_id, instance_id(), attach_as)
 
 
-@retry
-def get_all_tags(ec2, filters):
-    return ec2.get_all_tags(filters=filters)
-
-
 @retry
 def delete_tags(ec2, resource_ids, tags):
     ec2.delete_tags(resource_ids, tags)
 
 
-def find_volume(ec2, name):
-    """Looks up the EBS volume with a given Name tag"""
-    tries = 10
-    sleep_sec = 120
-    volumes = []
-    while not volumes:
-        try:
-            volumes = list(get_all_volumes(ec2, {
-                'tag:Name': name,
-                'status': 'available',
-                'availability-zone': zone()}))
-        except Exception as e:
-            logging.exception(e)
-            sys.exit(2)
+VOLUME_LOOKUP_TRIES = 10
+VOLUME_LOOKUP_WAIT_SECONDS = 120
+DEVICE_WAIT_SECONDS = 60
+DEVICE_POLL_INTERVAL = 0.2
 
-        if not volumes:
-            logging.error('No matching "available" EBS volume with name %s found.', name)
-            tries -= 1
-            if tries > 0:
-                logging.info('Sleeping for %d seconds and hope volume will become "available"', sleep_sec)
-                time.sleep(sleep_sec)
+
+def select_volumes(volumes, names):
+    """
+    Map each of the given names to the ID of an "available" EBS volume with that Name tag
+
+    >>> class Volume:
+    ...     def __init__(self, id, name):
+    ...         self.id, self.tags = id, {'Name': name}
+    >>> sorted(select_volumes([Volume('vol-2', 'a'), Volume('vol-1', 'a'), Volume('vol-3', 'b')], ['a', 'c']).items())
+    [('a', 'vol-1')]
+    """
+    found = {}
+    for volume in sorted(volumes, key=lambda v: v.id):
+        name = volume.tags.get('Name')
+        if name in names:
+            if name in found:
+                logging.warning('More than one EBS volume with name %s found.', name)
             else:
-                sys.exit(2)
+                found[name] = volume.id
+    return found
 
-    if len(volumes) > 1:
-        logging.warning('More than one EBS volume with name %s found.', name)
-        volumes.sort(key=lambda v: v.id)
-    return volumes[0].id
 
+def find_volumes(ec2, names):
+    """Looks up the EBS volumes with the given Name tags in one request"""
+    try:
+        volumes = get_all_volumes(ec2, {
+            'tag:Name': sorted(names),
+            'status': 'available',
+            'availability-zone': zone()})
+    except Exception as e:
+        logging.exception(e)
+        sys.exit(2)
+    return select_volumes(volumes, names)
 
-def wait_for_device(device, max_tries=12, wait_time=5):
-    """Gives device some time to be available in case it was recently attached"""
-    tries = 0
-    while True:
-        if os.path.exists(device):
-            try:
-                with open(device, 'rb'):
-                    return
-            except Exception as e:
-                logging.warning("Device %s not yet ready: %s", device, str(e))
-        logging.info("Waiting for %s to stabilize..", device)
-        tries += 1
-        if tries >= max_tries:
+
+def device_candidates(device):
+    """
+    Return the paths under which an attached device might show up
+
+    >>> device_candidates('/dev/sdf')
+    ['/dev/sdf', '/dev/xvdf']
+
+    >>> device_candidates('/dev/xvdf')
+    ['/dev/xvdf']
+    """
+    # /dev/sda is renamed into /dev/xvda
+    xv_device = device.replace('/dev/sd', '/dev/xvd')
+    return [device] if xv_device == device else [device, xv_device]
+
+
+def is_device_ready(device):
+    if not os.path.exists(device):
+        return False
+    try:
+        with open(device, 'rb'):
+            return True
+    except Exception as e:
+        logging.debug("Device %s not yet ready: %s", device, str(e))
+        return False
+
+
+def wait_for_devices(devices, timeout=DEVICE_WAIT_SECONDS, interval=DEVICE_POLL_INTERVAL):
+    """Waits for all devices together, each given as list of alternative paths"""
+    deadline = time.time() + timeout
+    pending = [candidates for candidates in devices
+               if not any(is_device_ready(device) for device in candidates)]
+    if pending:
+        logging.info("Waiting for %s to stabilize..", ', '.join(candidates[0] for candidates in pending))
+    while pending:
+        if time.time() >= deadline:
             logging.error("Failed to wait for %s device to become available after %s seconds",
-                          device, max_tries * wait_time)
+                          ', '.join(candidates[0] for candidates in pending), timeout)
             sys.exit(2)
-        sleep(wait_time)
+        sleep(interval)
+        pending = [candidates for candidates in pending
+                   if not any(is_device_ready(device) for device in candidates)]
+
+
+def wait_for_device(device, max_tries=12, wait_time=5):
+    """Gives device some time to be available in case it was recently attached"""
+    wait_for_devices([[device]], timeout=max_tries * wait_time)
 
 
 class CmdException(Exception):
@@ -141,40 +180,325 @@ class CmdException(Exception):
 
 
 def call_command(call):
-    proc = subprocess.Popen(call, stderr=subprocess.PIPE)
-    stdout, stderr = proc.communicate()
-    if proc.returncode != 0:
-        raise CmdException(proc.returncode, stderr.decode('utf-8'))
+    returncode, stdout, stderr = run_command(call)
+    # log the output instead of passing it through, so it does not interleave between devices
+    for line in stdout.decode('utf-8', errors='replace').splitlines():
+        if line.strip():
+            logging.info(line)
+    if returncode != 0:
+        raise CmdException(returncode, stderr.decode('utf-8'))
+
+
+DEFAULT_RAID_CHUNK = '512K'
+DEFAULT_BLOCK_SIZE = 4096
+# options of the "format" section of a mount
+FORMAT_OPTIONS = ('block_size', 'inode_ratio', 'bigalloc', 'cluster_size', 'lazy_itable_init', 'lazy_journal_init',
+                  'init_itable', 'stride', 'stripe_width')
+SIZE_UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
 
+def parse_size(value, default_unit=1):
+    """
+    Parses sizes like "512K" into bytes, plain numbers are multiplied with the default unit
+
+    >>> parse_size('512K'), parse_size('1m'), parse_size(65536), parse_size(64, default_unit=1024)
+    (524288, 1048576, 65536, 65536)
+    """
+    value = str(value).strip().upper()
+    if value and value[-1] in SIZE_UNITS:
+        return int(value[:-1]) * SIZE_UNITS[value[-1]]
+    return int(value) * default_unit
+
+
+def raid_data_disks(level, num_devices):
+    """
+    Returns the number of devices data is striped over
+
+    >>> [raid_data_disks(level, 4) for level in (0, 1, 5, 6, 10)]
+    [4, 1, 3, 2, 2]
+    """
+    level = int(level)
+    if level == 1:
+        return 1
+    elif level == 5:
+        return num_devices - 1
+    elif level == 6:
+        return num_devices - 2
+    elif level == 10:
+        return num_devices // 2
+    return num_devices
+
+
+def raid_geometry(raid_config):
+    """
+    Returns chunk size (bytes) and number of data disks of a striped RAID or None
+
+    >>> raid_geometry({'level': 0, 'devices': ['/dev/xvdf', '/dev/xvdg']})
+    (524288, 2)
+
+    >>> raid_geometry({'level': 1, 'devices': ['/dev/xvdf', '/dev/xvdg']})
+
+    >>> raid_geometry({'level': 5, 'chunk': '64K', 'devices': ['/dev/xvdf', '/dev/xvdg', '/dev/xvdh']})
+    (65536, 2)
+    """
+    if not raid_config:
+        return None
+    data_disks = raid_data_disks(raid_config.get('level', 0), len(raid_config.get('devices', [])))
+    if data_disks < 2:
+        return None
+    # mdadm takes plain chunk sizes in KiB
+    return parse_size(raid_config.get('chunk', DEFAULT_RAID_CHUNK), default_unit=1024), data_disks
+
+
+def format_flag(value):
+    return '1' if value else '0'
+
+
+def mkfs_command(partition, filesystem, format_options=None, raid_config=None, root_owner=None):
+    """
+    Builds the mkfs command line from the "format" options of a mount and the RAID layout
+
+    >>> mkfs_command('/dev/xvdf', 'ext4', root_owner='999:999')
+    ['mkfs.ext4', '-E', 'nodiscard,root_owner=999:999', '/dev/xvdf']
+
+    >>> mkfs_command('/dev/md/data', 'ext4', {'lazy_itable_init': True, 'lazy_journal_init': True,
+    ...                                       'inode_ratio': '1M'},
+    ...              {'level': 0, 'chunk': '256K', 'devices': ['/dev/xvdf', '/dev/xvdg']})
+    ... # doctest: +NORMALIZE_WHITESPACE
+    ['mkfs.ext4', '-i', '1048576', '-E',
+     'nodiscard,lazy_itable_init=1,lazy_journal_init=1,stride=64,stripe_width=128', '/dev/md/data']
+
+    >>> mkfs_command('/dev/xvdf', 'ext4', {'bigalloc': True, 'cluster_size': '64K'})
+    ['mkfs.ext4', '-O', 'bigalloc', '-C', '65536', '-E', 'nodiscard', '/dev/xvdf']
 
-def format_partition(partition, filesystem="ext4", initialize=False, is_already_mounted=False, is_root=False):
+    >>> mkfs_command('/dev/md/data', 'xfs', raid_config={'level': 10, 'devices': ['a', 'b', 'c', 'd']})
+    ['mkfs.xfs', '-K', '-d', 'su=512k,sw=2', '/dev/md/data']
+    """
+    format_options = format_options or {}
+    for key in sorted(format_options):
+        if key not in FORMAT_OPTIONS:
+            logging.warning('Ignoring unknown format option "%s"', key)
+
+    block_size = parse_size(format_options.get('block_size', DEFAULT_BLOCK_SIZE))
+    geometry = raid_geometry(raid_config)
+    call = ["mkfs." + filesystem]
+    if filesystem.startswith("ext"):
+        if 'block_size' in format_options:
+            call.extend(['-b', str(block_size)])
+        if 'inode_ratio' in format_options:
+            call.extend(['-i', str(parse_size(format_options['inode_ratio']))])
+        if format_options.get('bigalloc'):
+            call.extend(['-O', 'bigalloc'])
+            if 'cluster_size' in format_options:
+                call.extend(['-C', str(parse_size(format_options['cluster_size']))])
+
+        extended_options = ['nodiscard']
+        if root_owner:
+            extended_options.append("root_owner={}".format(root_owner))
+        for key in ('lazy_itable_init', 'lazy_journal_init'):
+            if key in format_options:
+                extended_options.append('{}={}'.format(key, format_flag(format_options[key])))
+        stride = format_options.get('stride')
+        stripe_width = format_options.get('stripe_width')
+        if geometry:
+            chunk, data_disks = geometry
+            stride = stride or chunk // block_size
+            stripe_width = stripe_width or int(stride) * data_disks
+        if stride:
+            extended_options.append('stride={}'.format(stride))
+        if stripe_width:
+            extended_options.append('stripe_width={}'.format(stripe_width))
+        call.extend(["-E", ",".join(extended_options)])
+    elif filesystem == 'xfs':
+        call.append('-K')  # nodiscard argument for mkfs.xfs
+        if geometry:
+            chunk, data_disks = geometry
+            call.extend(['-d', 'su={}k,sw={}'.format(chunk // 1024, data_disks)])
+    call.append(partition)
+    return call
+
+
+def get_mount_options(options, filesystem, format_options=None):
+    """
+    Adds mount options belonging to the "format" options of a mount
+
+    >>> get_mount_options('noatime', 'ext4', {'lazy_itable_init': True, 'init_itable': 2})
+    'noatime,init_itable=2'
+
+    >>> get_mount_options(None, 'xfs', {'init_itable': 2})
+    """
+    format_options = format_options or {}
+    if filesystem.startswith('ext') and 'init_itable' in format_options:
+        # throttles the background inode table initialization of lazy_itable_init
+        extra = 'init_itable={}'.format(int(format_options['init_itable']))
+        return '{},{}'.format(options, extra) if options else extra
+    return options
+
+
+def format_partition(partition, filesystem="ext4", initialize=False, is_already_mounted=False, is_root=False,
+                     format_options=None, raid_config=None):
     """Formats disks if initialize is True"""
     if initialize and not is_already_mounted and filesystem != 'tmpfs':
-        call = ["mkfs." + filesystem]
-        if filesystem.startswith("ext"):
-            extended_options = ['nodiscard']
-            if not is_root:
-                logging.debug("%s being formatted with unprivileged user as owner")
-                entry = pwd.getpwnam('application')
-                extended_options.append("root_owner={}:{}".format(entry.pw_uid, entry.pw_gid))
-            call.extend(["-E", ",".join(extended_options)])
-        elif filesystem == 'xfs':
-            call.append('-K')  # nodiscard argument for mkfs.xfs
-        call.append(partition)
+        root_owner = None
+        if filesystem.startswith("ext") and not is_root:
+            logging.debug("%s being formatted with unprivileged user as owner", partition)
+            entry = pwd.getpwnam('application')
+            root_owner = "{}:{}".format(entry.pw_uid, entry.pw_gid)
+        call = mkfs_command(partition, filesystem, format_options, raid_config, root_owner)
         wait_for_device(partition)
-        call_command(call)
+        logging.info("Formatting %s: %s", partition, ' '.join(call))
+        start = time.time()
+        with boot_phase('mkfs', target=partition):
+            call_command(call)
+        logging.info("Formatted %s in %.1f seconds", partition, time.time() - start)
     elif is_already_mounted:
         logging.warning("%s is already mounted.", partition)
     else:
         logging.info("Nothing to do for disk %s", partition)
 
 
-def check_partition(partition, filesystem):
+FSCK_MODES = ('always', 'smart', 'never')
+DEFAULT_FSCK_INTERVAL_DAYS = 30
+# XFS has no "last checked" time in its superblock, so we keep track of the checks ourselves
+FSCK_STATE_FILE = '/var/lib/taupage/fsck-state.json'
+DUMPE2FS_TIME_FORMAT = '%a %b %d %H:%M:%S %Y'
+
+_fsck_state_lock = threading.Lock()
+
+
+def parse_superblock(output):
+    """
+    Parses the "key: value" lines of dumpe2fs -h
+
+    >>> sorted(parse_superblock('Filesystem state:  clean\\nMount count:  3\\n').items())
+    [('Filesystem state', 'clean'), ('Mount count', '3')]
+    """
+    superblock = {}
+    for line in output.splitlines():
+        key, sep, value = line.partition(':')
+        if sep:
+            superblock[key.strip()] = value.strip()
+    return superblock
+
+
+def days_ago(timestamp, now):
+    return (now - timestamp) / 86400
+
+
+def ext_check_reason(superblock, now, interval_days):
+    """
+    Returns why a full check of an ext filesystem is needed or None
+
+    >>> now = time.mktime(time.strptime('Sun Oct 18 14:24:30 2026', DUMPE2FS_TIME_FORMAT))
+    >>> sb = {'Filesystem state': 'clean', 'Mount count': '3', 'Maximum mount count': '-1',
+    ...       'Last checked': 'Sat Oct 10 14:24:30 2026'}
+    >>> ext_check_reason(sb, now, 30)
+
+    >>> ext_check_reason(sb, now, 7)
+    'last checked 8 days ago'
+
+    >>> ext_check_reason(dict(sb, **{'Filesystem state': 'not clean'}), now, 30)
+    'filesystem state is "not clean"'
+
+    >>> ext_check_reason(dict(sb, **{'FS Error count': '2'}), now, 30)
+    '2 errors recorded'
+    """
+    state = superblock.get('Filesystem state')
+    if state != 'clean':
+        return 'filesystem state is "{}"'.format(state)
+    errors = int(superblock.get('FS Error count', 0))
+    if errors > 0:
+        return '{} errors recorded'.format(errors)
+    max_mount_count = int(superblock.get('Maximum mount count', -1))
+    if 0 < max_mount_count <= int(superblock.get('Mount count', 0)):
+        return 'maximum mount count reached'
+    last_checked = time.mktime(time.strptime(superblock['Last checked'], DUMPE2FS_TIME_FORMAT))
+    if days_ago(last_checked, now) > interval_days:
+        return 'last checked {:.0f} days ago'.format(days_ago(last_checked, now))
+    return None
+
+
+def read_command_output(call):
+    # dumpe2fs prints dates according to the locale
+    env = dict(os.environ, LC_ALL='C')
+    return subprocess.check_output(call, stderr=subprocess.DEVNULL, env=env).decode('utf-8', errors='replace')
+
+
+def load_fsck_state():
+    try:
+        with open(FSCK_STATE_FILE) as fd:
+            return json.load(fd)
+    except Exception:
+        return {}
+
+
+def save_fsck_time(uuid):
+    with _fsck_state_lock:
+        state = load_fsck_state()
+        state[uuid] = time.time()
+        os.makedirs(os.path.dirname(FSCK_STATE_FILE), exist_ok=True)
+        atomic_write(FSCK_STATE_FILE, json.dumps(state))
+
+
+def xfs_uuid(partition):
+    # prints "UUID = ..."
+    key, sep, uuid = read_command_output(['xfs_db', '-r', '-c', 'uuid', partition]).partition('=')
+    if not sep or key.strip() != 'UUID':
+        raise ValueError('No UUID found for {}'.format(partition))
+    return uuid.strip()
+
+
+def xfs_check_reason(partition, now, interval_days):
+    last_checked = load_fsck_state().get(xfs_uuid(partition))
+    if last_checked is None:
+        return 'no check recorded'
+    if days_ago(last_checked, now) > interval_days:
+        return 'last checked {:.0f} days ago'.format(days_ago(last_checked, now))
+    return None
+
+
+def full_check_reason(partition, filesystem, interval_days):
+    """Reads the superblock and returns why a full check is needed or None"""
+    try:
+        if filesystem.startswith('ext'):
+            superblock = parse_superblock(read_command_output(['dumpe2fs', '-h', partition]))
+            return ext_check_reason(superblock, time.time(), interval_days)
+        elif filesystem == 'xfs':
+            return xfs_check_reason(partition, time.time(), interval_days)
+    except Exception as e:
+        return 'could not read superblock: {}'.format(e)
+    return None
+
+
+def check_partition(partition, filesystem, mode='always', interval_days=DEFAULT_FSCK_INTERVAL_DAYS):
+    """
+    Checks the filesystem of a partition
+
+    In "smart" mode the full check is skipped for clean filesystems checked
+    within the interval, "never" disables the check completely.
+    """
+    if mode == 'never':
+        logging.info("Not checking filesystem on %s", partition)
+        with boot_phase('fsck_decision', target=partition, reason='skipped: fsck is "never"'):
+            return
+    reason = 'fsck is "{}"'.format(mode)
+    if mode == 'smart' and filesystem != 'tmpfs':
+        wait_for_device(partition)
+        with boot_phase('fsck_decision', target=partition) as phase:
+            reason = full_check_reason(partition, filesystem, interval_days)
+            phase['reason'] = reason or 'skipped: clean'
+        if reason is None:
+            logging.info("Skipping check of clean filesystem on %s (checked within %s days)",
+                         partition, interval_days)
+            return
+        logging.info("Checking filesystem on %s: %s", partition, reason)
+
     if filesystem.startswith('ext'):
         call = ['e2fsck', '-f', '-p', partition]
         wait_for_device(partition)
         try:
-            call_command(call)
+            with boot_phase('e2fsck', target=partition, reason=reason):
+                call_command(call)
         except CmdException as e:
             # see e2fsck(8) man page for description of exit codes
             if e.returncode <= 1:
@@ -192,7 +516,12 @@ def check_partition(partition, filesystem):
     elif filesystem == 'xfs':
         call = ['xfs_repair', partition]
         wait_for_device(partition)
-        call_command(call)
+        with boot_phase('xfs_repair', target=partition, reason=reason):
+            call_command(call)
+        try:
+            save_fsck_time(xfs_uuid(partition))
+        except Exception as e:
+            logging.warning("Could not record check of %s: %s", partition, str(e))
     elif filesystem != 'tmpfs':
         logging.warning('Unable to check filesystem on %s: %s is not supported',
                         partition, filesystem)
@@ -211,7 +540,8 @@ def mount_partition(partition, mountpoint, options, filesystem=None, dir_exists=
         call.extend([partition, mountpoint])
         if filesystem != 'tmpfs':
             wait_for_device(partition)
-        call_command(call)
+        with boot_phase('mount', target=mountpoint):
+            call_command(call)
     elif is_mounted is True and dir_exists is True:
         logging.warning("Directory %s already exists and device is already mounted.", mountpoint)
     else:
@@ -231,7 +561,8 @@ def extend_partition(partition, mountpoint, filesystem):
                 logging.warning('Unable to extend filesystem on %s: %s is not supported',
                                 partition, filesystem)
             return
-        call_command(call)
+        with boot_phase('resize', target=partition):
+            call_command(call)
     except Exception as e:
         logging.warning("Could not extend filesystem on %s: %s", partition, str(e))
 
@@ -239,7 +570,7 @@ def extend_partition(partition, mountpoint, filesystem):
 ERASE_ON_BOOT_TAG_NAME = 'Taupage:erase-on-boot'
 
 
-def should_format_volume(region, partition, erase_on_boot):
+def should_format_volume(erase_on_boot, erase_tag_set):
     """
     We need to take a safe decision whether to format a volume or not
     based on two inputs: value of user data flag and EBS volume tag.  The
@@ -257,87 +588,185 @@ def should_format_volume(region, partition, erase_on_boot):
             F | - | -
     -----------+---+---
             N | ! | -
+
+    >>> [should_format_volume(data, tag) for data in (True, False, None) for tag in (True, False)]
+    [True, True, False, False, True, False]
     """
-    erase_tag_set = False
-    #
-    # We should only try to query the EBS tags if user data doesn't
-    # tell us anything: otherwise this will crash the instances which
-    # don't have any role attached.
-    #
-    if erase_on_boot is None:
-        ec2 = ec2_client(region)
-        volumes = list(get_all_volumes(ec2, {
-            'attachment.instance-id': instance_id(),
-            'attachment.device': partition}))
-        if volumes:
+    return bool(erase_on_boot or (erase_on_boot is None and erase_tag_set))
+
+
+def find_erase_tagged_partitions(region, partitions):
+    """
+    Returns the partitions whose attached EBS volume has the erase-on-boot tag, clearing the tags
+
+    All volumes attached to the instance are listed in one request (including
+    their tags), the tags are removed with one batched request.
+    """
+    ec2 = ec2_client(region)
+    volumes = get_all_volumes(ec2, {'attachment.instance-id': instance_id()})
+    tagged = {}
+    for volume in volumes:
+        device = volume.attach_data.device if volume.attach_data else None
+        if device in partitions:
+            logging.info("%s: volume_id=%s", device, volume.id)
+            if volume.tags.get(ERASE_ON_BOOT_TAG_NAME) == 'True':
+                tagged[device] = volume.id
+
+    if tagged:
+        try:
+            delete_tags(ec2, sorted(tagged.values()), [ERASE_ON_BOOT_TAG_NAME])
+        except Exception as e:
+            logging.warning("could not clear tags, defaulting to no erase, exception: %s", str(e))
+            return set()
+    return set(tagged)
+
+
+DEFAULT_DISK_PREPARATION_JOBS = 4
+
+_current_job = threading.local()
+
+
+class DeviceLogFilter(logging.Filter):
+    """Prefixes log messages of mount jobs with their device, as jobs run in parallel"""
+
+    def filter(self, record):
+        device = getattr(_current_job, 'device', None)
+        if device:
+            record.msg = '{}: {}'.format(device, record.msg)
+        return True
+
+
+def mount_dependencies(mountpoints):
+    """
+    Returns the mount points each mount point depends on (nested mounts need their parent first)
+
+    >>> deps = mount_dependencies(['/mounts/data', '/mounts/data/logs', '/mounts/database'])
+    >>> [(mountpoint, sorted(deps[mountpoint])) for mountpoint in sorted(deps)]
+    [('/mounts/data', []), ('/mounts/data/logs', ['/mounts/data']), ('/mounts/database', [])]
+    """
+    return {mountpoint: {other for other in mountpoints
+                         if other != mountpoint and mountpoint.startswith(other.rstrip('/') + '/')}
+            for mountpoint in mountpoints}
+
+
+def prepare_mount(config, mountpoint, data, erase_tagged_partitions, max_tries=12, wait_time=5):
+    """Formats or checks, mounts and grows one partition"""
+    partition = data.get("partition")
+    filesystem = data.get("filesystem", "ext4")
+    erase_on_boot = data.get("erase_on_boot", None)
+    if not (isinstance(erase_on_boot, bool) or erase_on_boot is None):
+        logging.error('"erase_on_boot" must be boolean')
+        sys.exit(2)
+    fsck_mode = data.get("fsck", "always")
+    if fsck_mode not in FSCK_MODES:
+        logging.error('"fsck" must be one of %s', ', '.join(FSCK_MODES))
+        sys.exit(2)
+    fsck_interval_days = data.get("fsck_interval_days", DEFAULT_FSCK_INTERVAL_DAYS)
+    initialize = should_format_volume(erase_on_boot, partition in erase_tagged_partitions)
+    logging.info("%s: erase_on_boot=%s, erase_tag_set=%s",
+                 partition, erase_on_boot, partition in erase_tagged_partitions)
+    format_options = data.get('format') or {}
+    raid_config = ((config.get('volumes') or {}).get('raid') or {}).get(partition)
+    options = get_mount_options(data.get('options'), filesystem, format_options)
+    already_mounted = os.path.ismount(mountpoint)
+
+    if partition and not already_mounted:
+        tries = 0
+        while True:
             try:
-                volume_id = volumes[0].id
-                logging.info("%s: volume_id=%s", partition, volume_id)
-
-                tags = get_all_tags(ec2, {
-                    'resource-id': volume_id,
-                    'key': ERASE_ON_BOOT_TAG_NAME,
-                    'value': 'True'})
-                if list(tags):
-                    delete_tags(ec2, volume_id, [ERASE_ON_BOOT_TAG_NAME])
-                    erase_tag_set = True
+                if initialize:
+                    format_partition(partition, filesystem, initialize,
+                                     already_mounted, config.get('root'), format_options, raid_config)
+                else:
+                    check_partition(partition, filesystem, fsck_mode, fsck_interval_days)
+
+                mount_partition(partition, mountpoint, options, filesystem,
+                                os.path.isdir(mountpoint), already_mounted)
+
+                if not initialize:
+                    extend_partition(partition, mountpoint, filesystem)
+
+                # no exception occurred, so we are fine
+                break
             except Exception as e:
-                logging.warning("could not read tags, defaulting to no erase, exception: %s", str(e))
+                message = str(e)
+                if "Device or resource busy" in message:
+                    logging.warning("Device not yet ready: %s", message)
+                    tries += 1
+                    if tries >= max_tries:
+                        logging.error("Could not mount partition %s after %s attempts",
+                                      partition, max_tries)
+                        sys.exit(2)
+                    sleep(wait_time)
+                else:
+                    logging.error("Could not mount partition %s: %s", partition, message)
+                sys.exit(2)
 
-    logging.info("%s: erase_on_boot=%s, erase_tag_set=%s",
-                 partition, erase_on_boot, erase_tag_set)
 
-    return erase_on_boot or (erase_on_boot is None and erase_tag_set)
+def run_mount_job(config, mountpoint, data, erase_tagged_partitions):
+    _current_job.device = data.get("partition") or mountpoint
+    try:
+        prepare_mount(config, mountpoint, data, erase_tagged_partitions)
+    finally:
+        _current_job.device = None
+
 
+def iterate_mounts(region, config, jobs=DEFAULT_DISK_PREPARATION_JOBS):
+    """
+    Prepares all mount points, independent devices in parallel
 
-def iterate_mounts(region, config, max_tries=12, wait_time=5):
-    """Iterates over mount points file to provide disk device paths"""
+    A mount point only waits for the mount points it is nested in. After the
+    first failure no new jobs are started, the running ones are finished and
+    the failure is raised again (keeping its exit code).
+    """
+    mounts = {}
     for mountpoint, data in config.get("mounts", {}).items():
         # mount path below /mounts on the host system
         # (the path specifies the mount point inside the Docker container)
-        mountpoint = '/mounts{}'.format(mountpoint)
+        mounts['/mounts{}'.format(mountpoint)] = data
 
-        partition = data.get("partition")
-        filesystem = data.get("filesystem", "ext4")
-        erase_on_boot = data.get("erase_on_boot", None)
-        if not(isinstance(erase_on_boot, bool) or erase_on_boot is None):
-            logging.error('"erase_on_boot" must be boolean')
-            sys.exit(2)
-        initialize = should_format_volume(region, partition, erase_on_boot)
-        options = data.get('options')
-        already_mounted = os.path.ismount(mountpoint)
+    #
+    # We should only try to query the EBS tags if user data doesn't
+    # tell us anything: otherwise this will crash the instances which
+    # don't have any role attached.
+    #
+    undecided = {data.get("partition") for data in mounts.values()
+                 if data.get("partition") and data.get("erase_on_boot") is None}
+    erase_tagged_partitions = find_erase_tagged_partitions(region, undecided) if undecided else set()
+
+    dependencies = mount_dependencies(list(mounts))
+    pending = sorted(mounts)
+    done = set()
+    running = {}
+    failure = None
+
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        while pending or running:
+            if failure is None:
+                for mountpoint in [m for m in pending if dependencies[m] <= done]:
+                    if len(running) >= jobs:
+                        break
+                    pending.remove(mountpoint)
+                    future = executor.submit(run_mount_job, config, mountpoint, mounts[mountpoint],
+                                             erase_tagged_partitions)
+                    running[future] = mountpoint
+
+            if not running:
+                break
 
-        if partition and not already_mounted:
-            tries = 0
-            while True:
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                mountpoint = running.pop(future)
                 try:
-                    if initialize:
-                        format_partition(partition, filesystem, initialize,
-                                         already_mounted, config.get('root'))
-                    else:
-                        check_partition(partition, filesystem)
-
-                    mount_partition(partition, mountpoint, options, filesystem,
-                                    os.path.isdir(mountpoint), already_mounted)
-
-                    if not initialize:
-                        extend_partition(partition, mountpoint, filesystem)
+                    future.result()
+                    done.add(mountpoint)
+                except BaseException as e:
+                    if not isinstance(e, SystemExit):
+                        logging.error("Could not prepare %s: %s", mountpoint, str(e))
+                    failure = failure or e
 
-                    # no exception occurred, so we are fine
-                    break
-                except Exception as e:
-                    message = str(e)
-                    if "Device or resource busy" in message:
-                        logging.warning("Device not yet ready: %s", message)
-                        tries += 1
-                        if tries >= max_tries:
-                            logging.error("Could not mount partition %s after %s attempts",
-                                          partition, max_tries)
-                            sys.exit(2)
-                        sleep(wait_time)
-                    else:
-                        logging.error("Could not mount partition %s: %s", partition, message)
-                    sys.exit(2)
+    if failure is not None:
+        raise failure
 
 
 def expand_volume_name(name, subs):
@@ -355,28 +784,181 @@ def expand_volume_name(name, subs):
 
 
 def handle_ebs_volumes(region, ebs_volumes):
+    """
+    Attaches all EBS volumes and waits for their devices together
+
+    All names are resolved in one request, volumes which are not "available" yet
+    are looked up again while the others are already attaching.
+    """
     ec2 = ec2_client(region)
+    missing = {}
     for device, name in ebs_volumes.items():
-        # /dev/sda is renamed into /dev/xvda
-        xv_device = device.replace('/dev/sd', '/dev/xvd')
-        if os.path.exists(device) or os.path.exists(xv_device):
+        if any(os.path.exists(candidate) for candidate in device_candidates(device)):
             logging.info("Device already exists %s", device)
         else:
-            name = expand_volume_name(name, allowed_volume_name_subs())
-            try:
-                attach_volume(ec2, find_volume(ec2, name), device)
-            except Exception as e:
-                logging.exception(e)
-                sys.exit(3)
-            logging.info("Attached EBS volume '%s' as '%s'", name, device)
+            missing[device] = expand_volume_name(name, allowed_volume_name_subs())
+
+    attached = []
+    tries = VOLUME_LOOKUP_TRIES
+    while missing:
+        volume_ids = find_volumes(ec2, set(missing.values()))
+        # attachments are asynchronous, so all volumes attach concurrently
+        for device, name in sorted(missing.items()):
+            if name in volume_ids:
+                try:
+                    with boot_phase('attach_volume', target=device):
+                        attach_volume(ec2, volume_ids.pop(name), device)
+                except Exception as e:
+                    logging.exception(e)
+                    sys.exit(3)
+                logging.info("Attached EBS volume '%s' as '%s'", name, device)
+                attached.append(device)
+                del missing[device]
+
+        if missing:
+            for name in sorted(set(missing.values())):
+                logging.error('No matching "available" EBS volume with name %s found.', name)
+            tries -= 1
+            if tries > 0:
+                logging.info('Sleeping for %d seconds and hope volumes will become "available"',
+                             VOLUME_LOOKUP_WAIT_SECONDS)
+                time.sleep(VOLUME_LOOKUP_WAIT_SECONDS)
+            else:
+                sys.exit(2)
+
+    if attached:
+        with boot_phase('wait_for_devices'):
+            wait_for_devices([device_candidates(device) for device in attached])
+
+
+RAID_BITMAP_VALUES = ('internal', 'none')
+
+
+def parse_mdadm_scan(output):
+    """
+    Parses the ARRAY lines of "mdadm --detail --scan" or "mdadm --examine --scan"
+
+    >>> arrays = parse_mdadm_scan('ARRAY /dev/md/data metadata=1.2 UUID=3a:1b name=ip-1:data')
+    >>> [sorted(array.items()) for array in arrays]
+    [[('device', '/dev/md/data'), ('metadata', '1.2'), ('name', 'ip-1:data'), ('uuid', '3a:1b')]]
+    """
+    arrays = []
+    for line in output.splitlines():
+        parts = line.split()
+        if len(parts) >= 2 and parts[0] == 'ARRAY':
+            array = {'device': parts[1]}
+            for part in parts[2:]:
+                key, sep, value = part.partition('=')
+                if sep:
+                    array[key.lower()] = value
+            arrays.append(array)
+    return arrays
+
+
+def md_array_name(device):
+    """
+    Returns the name of an md array as used for its /dev/md/<name> link, "/dev/mdN" is the same array as "/dev/md/N"
+
+    >>> md_array_name('/dev/md0'), md_array_name('/dev/md/0'), md_array_name('/dev/md/127')
+    ('0', '0', '127')
+    """
+    name = os.path.basename(device)
+    if name.startswith('md') and name[2:].isdigit():
+        return name[2:]
+    return name
+
+
+def find_array(arrays, raid_device):
+    """
+    Returns the scanned array belonging to a configured RAID device (by path or by array name) or None
 
+    The path and the array name ("<host>:<name>") are compared by name,
+    so /dev/md0, /dev/md/0 and an array named "ip-1:0" all match.
 
-def raid_device_exists(raid_device):
+    >>> arrays = [{'device': '/dev/md/127', 'name': 'ip-1:data'}, {'device': '/dev/md0'}]
+    >>> find_array(arrays, '/dev/md/data')['device'], find_array(arrays, '/dev/md0')['device']
+    ('/dev/md/127', '/dev/md0')
+
+    >>> find_array(arrays, '/dev/md/0')['device'], find_array(arrays, '/dev/md127')['device']
+    ('/dev/md0', '/dev/md/127')
+
+    >>> find_array([{'device': '/dev/md127', 'name': 'ip-1:0'}], '/dev/md0')['device']
+    '/dev/md127'
+
+    >>> find_array(arrays, '/dev/md/logs')
+    """
+    wanted = md_array_name(raid_device)
+    for array in arrays:
+        name = array.get('name', '').rpartition(':')[2]
+        if md_array_name(array['device']) == wanted or (name and name == wanted):
+            return array
+    return None
+
+
+def scan_arrays(mode):
+    """Scans for RAID arrays in one pass, "--detail" lists active arrays, "--examine" the ones on devices"""
     try:
-        subprocess.check_call(["mdadm", raid_device])
-        return True
-    except Exception:
-        return False
+        return parse_mdadm_scan(subprocess.check_output(['mdadm', mode, '--scan']).decode('utf-8'))
+    except Exception as e:
+        logging.warning("Could not scan RAID arrays: %s", str(e))
+        return []
+
+
+def mdadm_create_command(raid_device, raid_config):
+    """
+    >>> mdadm_create_command('/dev/md/data', {'level': 0, 'devices': ['/dev/xvdf', '/dev/xvdg']})
+    ['mdadm', '--create', '/dev/md/data', '--run', '--level=0', '--raid-devices=2', '/dev/xvdf', '/dev/xvdg']
+
+    >>> mdadm_create_command('/dev/md/data', {'level': 10, 'chunk': '256K', 'assume_clean': True, 'bitmap': 'internal',
+    ...                                       'devices': ['a', 'b', 'c', 'd']})[5:]
+    ['--raid-devices=4', '--chunk=256K', '--assume-clean', '--bitmap=internal', 'a', 'b', 'c', 'd']
+
+    >>> mdadm_create_command('/dev/md/data', {'level': 5, 'assume_clean': True, 'devices': ['a', 'b', 'c']})
+    ['mdadm', '--create', '/dev/md/data', '--run', '--level=5', '--raid-devices=3', 'a', 'b', 'c']
+    """
+    devices = raid_config.get("devices", [])
+    call = ["mdadm",
+            "--create", raid_device,
+            "--run",
+            "--level=" + str(raid_config.get("level")),
+            "--raid-devices=" + str(len(devices))]
+    if raid_config.get("chunk") and int(raid_config.get("level")) != 1:
+        call.append("--chunk={}K".format(parse_size(raid_config["chunk"], default_unit=1024) // 1024))
+    if raid_config.get("assume_clean"):
+        if str(raid_config.get("level")) in ("5", "6"):
+            # parity of devices that were not zeroed stays inconsistent after read-modify-write
+            # updates, a later rebuild would then silently reconstruct corrupted data
+            logging.warning("Ignoring assume_clean for RAID%s %s, the initial resync is required for parity",
+                            raid_config.get("level"), raid_device)
+        else:
+            # skips the initial resync: mirrors only differ in blocks never written by the filesystem
+            call.append("--assume-clean")
+    if raid_config.get("bitmap"):
+        call.append("--bitmap={}".format(raid_config["bitmap"]))
+    return call + devices
+
+
+def run_mdadm(call, step, raid_device, max_tries=12, wait_time=5):
+    tries = 0
+    while True:
+        try:
+            with boot_phase(step, target=raid_device):
+                call_command(call)
+            return
+        except Exception as e:
+            message = str(e)
+            if "Device or resource busy" in message:
+                logging.warning("Device not yet ready: %s", message)
+                tries += 1
+                if tries >= max_tries:
+                    logging.error("Could not %s device %s after %s attempts",
+                                  step.replace('_', ' '), raid_device, max_tries)
+                    sys.exit(2)
+                sleep(wait_time)
+            else:
+                logging.error("Could not %s device %s: %s",
+                              step.replace('_', ' '), raid_device, message)
+                sys.exit(2)
 
 
 def create_raid_device(raid_device, raid_config, max_tries=12, wait_time=5):
@@ -385,47 +967,332 @@ def create_raid_device(raid_device, raid_config, max_tries=12, wait_time=5):
     if num_devices < 2:
         logging.error("You need at least 2 devices to create a RAID")
         sys.exit(4)
-    else:
-        raid_level = raid_config.get("level")
-        call = ["mdadm",
-                "--create", raid_device,
-                "--run",
-                "--level=" + str(raid_level),
-                "--raid-devices=" + str(num_devices)] + devices
+    bitmap = raid_config.get("bitmap")
+    if bitmap and bitmap not in RAID_BITMAP_VALUES and not str(bitmap).startswith('/'):
+        logging.error('"bitmap" must be one of %s or a file path', ', '.join(RAID_BITMAP_VALUES))
+        sys.exit(4)
 
-        tries = 0
-        while True:
+    raid_level = raid_config.get("level")
+    run_mdadm(mdadm_create_command(raid_device, raid_config), 'create_raid', raid_device, max_tries, wait_time)
+    logging.info("Created RAID%d device %s", raid_level, raid_device)
+
+
+def assemble_raid_device(raid_device, raid_config, max_tries=12, wait_time=5):
+    """Assembles an existing array from its devices instead of creating a new one"""
+    call = ["mdadm", "--assemble", raid_device, "--run"] + raid_config.get("devices", [])
+    run_mdadm(call, 'assemble_raid', raid_device, max_tries, wait_time)
+    logging.info("Assembled existing RAID device %s", raid_device)
+
+
+def set_resync_speed(raid_device, raid_config):
+    """Applies the resync speed limits (KB/s) of the RAID config to the md device"""
+    md_dir = '/sys/block/{}/md'.format(os.path.basename(os.path.realpath(raid_device)))
+    for key, sysfs_name in (('resync_speed_min', 'sync_speed_min'), ('resync_speed_max', 'sync_speed_max')):
+        if key in raid_config:
             try:
-                call_command(call)
+                with open(os.path.join(md_dir, sysfs_name), 'w') as fd:
+                    fd.write('{}\n'.format(int(raid_config[key])))
+                logging.info("Set %s of %s to %s KB/s", sysfs_name, raid_device, raid_config[key])
             except Exception as e:
-                message = str(e)
-                if "Device or resource busy" in message:
-                    logging.warning("Device not yet ready: %s", message)
-                    tries += 1
-                    if tries >= max_tries:
-                        logging.error("Could not create RAID device %s after %s attempts",
-                                      raid_device, max_tries)
-                        sys.exit(2)
-                    sleep(wait_time)
-                else:
-                    logging.error("Could not create RAID device %s: %s",
-                                  raid_device, message)
-                    sys.exit(2)
-            else:
-                logging.info("Created RAID%d device %s", raid_level, raid_device)
-                break
+                logging.warning("Could not set %s of %s: %s", sysfs_name, raid_device, str(e))
 
 
 def handle_raid_volumes(raid_volumes):
-    for raid_device, raid_config in raid_volumes.items():
-        # Give devices some time to be available in case they were recently attached
-        for device in raid_config.get("devices", []):
-            wait_for_device(device)
+    # Give devices some time to be available in case they were recently attached
+    wait_for_devices([[device] for raid_config in raid_volumes.values() for device in raid_config.get("devices", [])],
+                     timeout=DEVICE_WAIT_SECONDS)
 
-        if raid_device_exists(raid_device):
+    # one scan for all arrays: the active ones and the ones found on the devices
+    active_arrays = scan_arrays('--detail')
+    existing_arrays = scan_arrays('--examine')
+
+    for raid_device, raid_config in raid_volumes.items():
+        if find_array(active_arrays, raid_device):
             logging.info("%s already exists", raid_device)
+        elif find_array(existing_arrays, raid_device):
+            assemble_raid_device(raid_device, raid_config)
         else:
             create_raid_device(raid_device, raid_config)
+        set_resync_speed(raid_device, raid_config)
+
+
+INSTANCE_STORE_PARTITION = 'instance-store'
+INSTANCE_STORE_MODEL = 'Amazon EC2 NVMe Instance Storage'
+INSTANCE_STORE_RAID_DEVICE = '/dev/md/instance-store'
+
+
+def read_sysfs(path):
+    try:
+        with open(path) as fd:
+            return fd.read().strip()
+    except OSError:
+        return None
+
+
+def mounted_devices():
+    with open('/proc/mounts') as fd:
+        return {line.split()[0] for line in fd if line.startswith('/dev/')}
+
+
+def is_device_mounted(name, mounted):
+    """
+    >>> is_device_mounted('nvme1n1', {'/dev/nvme1n1p1', '/dev/nvme0n1'})
+    True
+
+    >>> is_device_mounted('nvme1n1', {'/dev/nvme11n1'})
+    False
+    """
+    device = '/dev/' + name
+    return any(source == device or (source.startswith(device + 'p') and source[len(device) + 1:].isdigit())
+               for source in mounted)
+
+
+def discover_instance_store_devices(sys_block='/sys/block'):
+    """Returns the local NVMe instance store devices (EBS volumes and mounted devices like root are excluded)"""
+    mounted = mounted_devices()
+    devices = []
+    for path in sorted(glob.glob(os.path.join(sys_block, 'nvme*'))):
+        name = os.path.basename(path)
+        # EBS volumes are "Amazon Elastic Block Store"
+        if read_sysfs(os.path.join(path, 'device', 'model')) != INSTANCE_STORE_MODEL:
+            continue
+        if is_device_mounted(name, mounted):
+            logging.info("Skipping mounted instance store device /dev/%s", name)
+            continue
+        devices.append('/dev/' + name)
+    return devices
+
+
+def has_filesystem(device):
+    # blkid exits with 2 if nothing was found
+    return subprocess.call(['blkid', '-p', device], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0
+
+
+def handle_instance_store(config):
+    """
+    Resolves a mount with "partition: instance-store" to the local NVMe instance store
+
+    A single device is used directly, several devices are striped into a RAID0.
+    Without an explicit "erase_on_boot" the device is formatted if it has no filesystem yet
+    (instance store is empty after every stop/start).
+    """
+    mounts = [data for data in (config.get("mounts") or {}).values()
+              if isinstance(data, dict) and data.get("partition") == INSTANCE_STORE_PARTITION]
+    if not mounts:
+        return
+    if len(mounts) > 1:
+        logging.error('Only one mount can use the "%s" partition', INSTANCE_STORE_PARTITION)
+        sys.exit(2)
+    data = mounts[0]
+
+    devices = discover_instance_store_devices()
+    if not devices:
+        logging.error("No NVMe instance store devices found")
+        sys.exit(2)
+    logging.info("Found instance store devices: %s", ', '.join(devices))
+
+    if len(devices) == 1:
+        partition = devices[0]
+    else:
+        partition = INSTANCE_STORE_RAID_DEVICE
+        raid_config = {'level': 0, 'devices': devices}
+        if data.get('chunk'):
+            raid_config['chunk'] = data['chunk']
+        # also used to derive the filesystem geometry
+        config['volumes'] = config.get('volumes') or {}
+        config['volumes']['raid'] = config['volumes'].get('raid') or {}
+        config['volumes']['raid'][partition] = raid_config
+        handle_raid_volumes({partition: raid_config})
+
+    data['partition'] = partition
+    if data.get('erase_on_boot') is None:
+        data['erase_on_boot'] = not has_filesystem(partition)
+
+
+# allowed /sys/block/*/queue settings with their allowed values (None: any non-negative number),
+# in the order they are applied (nr_requests depends on the scheduler)
+QUEUE_SETTINGS = (
+    ('scheduler', ('none', 'mq-deadline', 'kyber', 'bfq', 'noop', 'deadline', 'cfq')),
+    ('nr_requests', None),
+    ('read_ahead_kb', None),
+    ('max_sectors_kb', None),
+    ('rq_affinity', ('0', '1', '2')),
+    ('nomerges', ('0', '1', '2')),
+    ('add_random', ('0', '1')),
+    ('iostats', ('0', '1')),
+    ('wbt_lat_usec', None),
+)
+QUEUE_UDEV_RULES_FILE = '/etc/udev/rules.d/90-taupage-block-queue.rules'
+
+
+def validate_queue_settings(settings):
+    """
+    Validates the "queue" settings of a mount against the allowlist, returns them as ordered list
+
+    >>> validate_queue_settings({'read_ahead_kb': 4096, 'scheduler': 'mq-deadline'})
+    [('scheduler', 'mq-deadline'), ('read_ahead_kb', '4096')]
+
+    >>> validate_queue_settings({'max_hw_sectors_kb': 1})
+    Traceback (most recent call last):
+    ...
+    ValueError: queue setting max_hw_sectors_kb is not allowed
+
+    >>> validate_queue_settings({'rq_affinity': 3})
+    Traceback (most recent call last):
+    ...
+    ValueError: invalid value 3 for queue setting rq_affinity
+    """
+    allowed = dict(QUEUE_SETTINGS)
+    for key in sorted(settings):
+        if key not in allowed:
+            raise ValueError('queue setting {} is not allowed'.format(key))
+
+    validated = []
+    for key, values in QUEUE_SETTINGS:
+        if key in settings:
+            value = str(settings[key])
+            if (values is None and not value.isdigit()) or (values is not None and value not in values):
+                raise ValueError('invalid value {} for queue setting {}'.format(settings[key], key))
+            validated.append((key, value))
+    return validated
+
+
+def block_device_name(device):
+    """Returns the kernel name of the whole disk a device path (symlink or partition) belongs to"""
+    name = os.path.basename(os.path.realpath(device))
+    sys_path = os.path.realpath(os.path.join('/sys/class/block', name))
+    if os.path.exists(os.path.join(sys_path, 'partition')):
+        name = os.path.basename(os.path.dirname(sys_path))
+    return name
+
+
+def block_device_members(name):
+    """Returns the member devices of a md device (empty for normal disks)"""
+    return sorted(os.listdir(os.path.join('/sys/block', name, 'slaves'))) \
+        if os.path.isdir(os.path.join('/sys/block', name, 'slaves')) else []
+
+
+def parse_udev_properties(output):
+    """
+    >>> sorted(parse_udev_properties('DEVNAME=/dev/md127\\nMD_UUID=a1:b2\\n').items())
+    [('DEVNAME', '/dev/md127'), ('MD_UUID', 'a1:b2')]
+    """
+    properties = {}
+    for line in output.splitlines():
+        key, sep, value = line.partition('=')
+        if sep:
+            properties[key.strip()] = value.strip()
+    return properties
+
+
+def udev_properties(name):
+    try:
+        return parse_udev_properties(read_command_output(['udevadm', 'info', '--query=property',
+                                                          '--name=/dev/{}'.format(name)]))
+    except Exception as e:
+        logging.warning("Could not read udev properties of %s: %s", name, str(e))
+        return {}
+
+
+def udev_match(name, properties, member=False):
+    """
+    Returns the udev match key for a whole disk, by an identifier that is stable across re-attachment and
+    reboots (kernel names like md127 or nvme1n1 are not): the array UUID for md devices, the serial
+    number (the EBS volume ID on NVMe) otherwise. Xen devices (xvdf) have no serial, but a stable name.
+
+    Member disks of an array carry the MD_UUID of the array as well, so it is not used for them:
+    the rule would match all members and the array itself.
+
+    >>> udev_match('md127', {'MD_UUID': 'a1:b2', 'ID_SERIAL': 'x'})
+    'ENV{MD_UUID}=="a1:b2"'
+    >>> udev_match('nvme1n1', {'ID_SERIAL': 'Amazon Elastic Block Store_vol0123'})
+    'ENV{ID_SERIAL}=="Amazon Elastic Block Store_vol0123"'
+    >>> udev_match('nvme1n1', {'MD_UUID': 'a1:b2', 'ID_SERIAL': 'vol0123'}, member=True)
+    'ENV{ID_SERIAL}=="vol0123"'
+    >>> udev_match('xvdf', {'MD_UUID': 'a1:b2'}, member=True)
+    'KERNEL=="xvdf"'
+    >>> udev_match('nvme1n1', {})
+    """
+    for key in (('ID_SERIAL',) if member else ('MD_UUID', 'ID_SERIAL')):
+        if properties.get(key):
+            return 'ENV{{{}}}=="{}"'.format(key, properties[key].replace('"', ''))
+    if name.startswith('xvd') or name.startswith('sd'):
+        return 'KERNEL=="{}"'.format(name)
+    return None
+
+
+def udev_queue_rule(match, settings):
+    """
+    >>> print(udev_queue_rule('ENV{MD_UUID}=="a1:b2"', [('read_ahead_kb', '4096')]).replace(', ', '\\n'))
+    ACTION=="add|change"
+    SUBSYSTEM=="block"
+    ENV{DEVTYPE}=="disk"
+    ENV{MD_UUID}=="a1:b2"
+    ATTR{queue/read_ahead_kb}="4096"
+    """
+    return ', '.join(['ACTION=="add|change"', 'SUBSYSTEM=="block"', 'ENV{DEVTYPE}=="disk"', match] +
+                     ['ATTR{{queue/{}}}="{}"'.format(key, value) for key, value in settings])
+
+
+def apply_queue_settings(name, settings):
+    for key, value in settings:
+        path = os.path.join('/sys/block', name, 'queue', key)
+        try:
+            with open(path, 'w') as fd:
+                fd.write(value + '\n')
+            logging.info("Set %s of %s to %s", key, name, value)
+        except Exception as e:
+            # e.g. md devices have no scheduler
+            logging.warning("Could not set %s of %s: %s", key, name, str(e))
+
+
+def handle_queue_settings(config):
+    """
+    Applies the "queue" settings of all mounts to their devices (md devices including their members)
+
+    The settings are also written as udev rules, so they are applied again when devices are re-attached.
+    """
+    rules = []
+    for mountpoint, data in sorted((config.get("mounts") or {}).items()):
+        if not data.get("queue") or data.get("filesystem") == 'tmpfs':
+            continue
+        try:
+            settings = validate_queue_settings(data["queue"])
+        except ValueError as e:
+            logging.error('Invalid "queue" settings for %s: %s', mountpoint, e)
+            sys.exit(2)
+
+        if not data.get("partition"):
+            logging.error('No "partition" for %s, not applying its "queue" settings', mountpoint)
+            continue
+
+        wait_for_device(data["partition"])
+        name = block_device_name(data["partition"])
+        members = block_device_members(name)
+        for device_name in [name] + members:
+            apply_queue_settings(device_name, settings)
+            match = udev_match(device_name, udev_properties(device_name), member=device_name in members)
+            if match:
+                rules.append(udev_queue_rule(match, settings))
+            else:
+                logging.warning("No stable identifier for %s, queue settings are not applied on re-attachment",
+                                device_name)
+
+    if rules:
+        try:
+            atomic_write(QUEUE_UDEV_RULES_FILE,
+                         '# generated by Taupage from the "queue" settings of the mounts\n' + '\n'.join(rules) + '\n',
+                         mode=0o644)
+        except Exception as e:
+            logging.warning("Could not write udev rules for queue settings: %s", str(e))
+    else:
+        # no stale rules from a previous configuration
+        try:
+            os.remove(QUEUE_UDEV_RULES_FILE)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.warning("Could not remove udev rules for queue settings: %s", str(e))
 
 
 def handle_volumes(region, config):
@@ -448,6 +1315,10 @@ def process_arguments():
     parser.add_argument('-r', '--region', dest='region',
                         help='uses a specific AWS region instead of querying the instance metadata')
     parser.add_argument('--dry-run', action='store_true', help='only do a dry run and output what would be executed')
+    parser.add_argument('-j', '--jobs', type=int,
+                        help='maximum number of devices to prepare in parallel '
+                             '(default: "disk_preparation_jobs" of the config or {})'.format(
+                                 DEFAULT_DISK_PREPARATION_JOBS))
 
     return parser.parse_args()
 
@@ -459,6 +1330,7 @@ def main():
         configure_logging(logging.DEBUG)
     else:
         configure_logging(logging.INFO)
+    logging.getLogger().addFilter(DeviceLogFilter())
 
     current_region = args.region if args.region else detect_region()
 
@@ -468,8 +1340,13 @@ def main():
     if config.get("volumes"):
         handle_volumes(current_region, config)
 
+    handle_instance_store(config)
+
+    handle_queue_settings(config)
+
     # Iterate over mount points
-    iterate_mounts(current_region, config)
+    jobs = args.jobs or config.get('disk_preparation_jobs', DEFAULT_DISK_PREPARATION_JOBS)
+    iterate_mounts(current_region, config, int(jobs))
 
 
 if __name__ == '__main__':
@@ -16,17 +16,27 @@ echo "INFO: Starting Taupage AMI init process.."
 date --utc --iso-8601=seconds | tee /run/taupage-init-ran/date
 START_TIME=$(date +"%s")
 
+# export the boot timeline exactly once: after notifying CloudFormation,
+# or when exiting early (failed boots are the interesting ones)
+TIMELINE_EXPORTED=
+export_boot_timeline() {
+    if [ -z "$TIMELINE_EXPORTED" ]; then
+        TIMELINE_EXPORTED=1
+        /opt/taupage/bin/write-boot-timeline.py --boot-start "$START_TIME" --exit-code "$1"
+    fi
+}
+trap 'export_boot_timeline $?' EXIT
+
 # reset dir
 cd $(dirname $0)
 
 # general preparation
-for script in ./init.d/*; do
-    ./$script
-    if [ "$?" -ne 0 ]; then
-        echo "ERROR: $script did not successfully finish" >&2
-        exit 1
-    fi
-done
+# independent init scripts are run in parallel (see "depends-on:" headers)
+/opt/taupage/bin/run-init-scripts.py ./init.d
+if [ "$?" -ne 0 ]; then
+    echo "ERROR: init scripts did not successfully finish" >&2
+    exit 1
+fi
 
 if [ -z "$config_runtime" ]; then
     echo "ERROR: No runtime configuration found!" >&2
@@ -80,6 +90,8 @@ else
     cfn-signal -e "$result" --stack "$config_notify_cfn_stack" --resource "$config_notify_cfn_resource" --region "$EC2_REGION"
 fi
 
+export_boot_timeline "$result"
+
 END_TIME=$(date +"%s")
 ELAPSED_SECONDS=$(($END_TIME-$START_TIME))
 
@@ -4,24 +4,37 @@ Docker runtime script: load /meta/taupage.yaml and run the Docker container
 '''
 
 import argparse
-import base64
-import boto.kms
-import boto.utils
+import fcntl
 import functools
+import json
 import logging
-import pierone.api
 import pwd
 import requests
+import socket
 import sys
 import subprocess
 import time
-import yaml
 import os
 import glob
 
-from taupage import is_sensitive_key, CREDENTIALS_DIR, get_or, get_default_port
+from taupage import atomic_write, is_sensitive_key, is_trusted_file, CREDENTIALS_DIR, get_config, get_or, \
+    get_default_port, integer_port
+from taupage.kms import decrypt_values, is_kms_encrypted
+from taupage.registry import RegistryClient
+from taupage.timeline import boot_phase, format_metric, run_command, write_textfile
 
-AWS_KMS_PREFIX = 'aws:kms:'
+
+HEALTH_CHECK_MIN_INTERVAL = 0.1
+HEALTH_CHECK_MAX_INTERVAL = 2
+# waiting for the port is only a hint, start HTTP probing after this time anyway
+HEALTH_CHECK_PORT_WAIT_SECONDS = 10
+HEALTH_CHECK_PROM_FILE = 'taupage_health_check.prom'
+PROC_NET_TCP_FILES = ('/proc/net/tcp', '/proc/net/tcp6')
+TCP_LISTEN = '0A'
+
+PREFETCH_LOCK_FILE = '/run/taupage/image-prefetch.lock'
+PREFETCH_RESULT_FILE = '/run/taupage/image-prefetch.json'
+DOCKER_DATA_DIR = '/var/lib/docker'
 
 
 class PermanentError(Exception):
@@ -50,42 +63,6 @@ def retry(name, max_tries=3, retry_delay=5):
     return decorator
 
 
-def get_region():
-    identity = boto.utils.get_instance_identity()['document']
-    return identity['region']
-
-
-def decrypt(val):
-    '''
-    >>> decrypt(True)
-    True
-
-    >>> decrypt('test')
-    'test'
-    '''
-    if str(val).startswith(AWS_KMS_PREFIX):
-        ciphertext_blob = val[len(AWS_KMS_PREFIX):]
-        ciphertext_blob = base64.b64decode(ciphertext_blob)
-        conn = boto.kms.connect_to_region(get_region())
-        count = 0
-        while True:
-            try:
-                data = conn.decrypt(ciphertext_blob)
-                break
-            except boto.exception.BotoServerError as e:
-                if count >= 10 or str(e.error_code) not in ('Throttling', 'RequestLimitExceeded'):
-                    raise
-                logging.info('Throttling AWS API requests...')
-                time.sleep(2 ** count * 0.5)
-                count += 1
-
-        if 'Plaintext' not in data:
-            raise Exception('KMS decrypt failed')
-        return data['Plaintext'].decode('utf-8')
-    else:
-        return val
-
-
 def mask_command(cmd: list, secret_envs: frozenset):
     '''
     >>> mask_command([], frozenset({}))
@@ -123,7 +100,7 @@ def get_secret_envs(config: dict):
     env_vars = config.get('environment', {})
     if not env_vars or type(env_vars) != dict:
         return frozenset()
-    secret_keys = [k for k, v in env_vars.items() if type(v) == str and v.startswith(AWS_KMS_PREFIX)]
+    secret_keys = [k for k, v in env_vars.items() if is_kms_encrypted(v)]
     return frozenset(secret_keys)
 
 
@@ -139,17 +116,18 @@ def wait_for_local_planb_tokeninfo():
     timeout_seconds = 30
 
     start = time.time()
-    while time.time() < start + timeout_seconds:
-        logging.info('Waiting for local Plan B Token Info..')
-        try:
-            response = requests.get(health_url, timeout=5)
-            if response.status_code == 200:
-                logging.info('Local Plan B Token Info returned OK')
-                return tokeninfo_url
-        except Exception:
-            pass
+    with boot_phase('wait_for_local_planb_tokeninfo'):
+        while time.time() < start + timeout_seconds:
+            logging.info('Waiting for local Plan B Token Info..')
+            try:
+                response = requests.get(health_url, timeout=5)
+                if response.status_code == 200:
+                    logging.info('Local Plan B Token Info returned OK')
+                    return tokeninfo_url
+            except Exception:
+                pass
 
-        time.sleep(2)
+            time.sleep(2)
 
     logging.error('Timeout of {}s expired for local Plan B Token Info'.format(timeout_seconds))
     # failed to start local Token Info
@@ -182,9 +160,13 @@ def get_env_options(config: dict):
         yield '-e'
         yield 'TOKENINFO_URL={}'.format(tokeninfo_url)
 
-    for key, val in get_or(config, 'environment', {}).items():
+    environment = get_or(config, 'environment', {})
+    # decrypt all KMS encrypted values up front and concurrently
+    with boot_phase('decrypt_environment'):
+        plaintexts = decrypt_values(environment.values())
+    for key, val in environment.items():
         yield '-e'
-        yield '{}={}'.format(key, decrypt(val))
+        yield '{}={}'.format(key, plaintexts[val] if is_kms_encrypted(val) else val)
 
     if config.get('etcd_discovery_domain'):
         # TODO: use dynamic IP of docker0
@@ -333,44 +315,77 @@ def get_other_options(config: dict):
         yield '--shm-size={}'.format(config.get('shm_size'))
 
 
-def registry_requires_auth(registry: str):
-    return registry == 'pierone.stups.zalan.do'
+@retry("Docker run", max_tries=3, retry_delay=5)
+def start_docker(cmd):
+    return run_command(cmd, check=True, capture_stderr=False)[1].decode('utf-8').strip()
 
 
-def registry_login(config: dict, registry: str):
-    if registry_requires_auth(registry):
-        pierone_url = 'https://{}'.format(registry)
-        pierone.api.docker_login_with_iid(pierone_url)
+def run_docker(cmd, dry_run):
+    if not args.dry_run:
+        with boot_phase('docker_run'):
+            container_id = start_docker(cmd)
+        logging.info('Container {} is running'.format(container_id))
 
 
-@retry("verifying trusted image", max_tries=3, retry_delay=5)
-def verify_image_trusted(registry, org, name, tag):
-    if registry_requires_auth(registry):
-        headers = {"Authorization": "Basic {}".format(pierone.api.iid_auth())}
-    else:
-        headers = {}
+def is_port_listening(port: int, proc_files=PROC_NET_TCP_FILES):
+    '''Check whether any TCP socket is listening on the given port, return None if unknown'''
+    found_file = False
+    for fn in proc_files:
+        try:
+            with open(fn) as fd:
+                found_file = True
+                next(fd)  # skip header
+                for line in fd:
+                    fields = line.split()
+                    local_address, state = fields[1], fields[3]
+                    if state == TCP_LISTEN and int(local_address.rsplit(':', 1)[1], 16) == port:
+                        return True
+        except OSError:
+            pass
+    return False if found_file else None
 
-    url = "https://{}/v2/{}/{}/manifests/{}".format(registry, org, name, tag)
-    response = requests.get(url, headers=headers, timeout=30)
-    response.raise_for_status()
 
-    ready = response.headers.get("X-Production-Ready-Taupage") or response.headers.get("X-Trusted")
-    if ready == "true":
-        return
+def is_port_open(port: int):
+    if is_port_listening(port):
+        return True
+    # not (or not known to be) listening: the port might still be reachable without a listener
+    # in the host network namespace (e.g. forwarded by iptables with --userland-proxy=false)
+    try:
+        with socket.create_connection(('localhost', port), timeout=1):
+            return True
+    except OSError:
+        return False
 
-    message = response.headers.get("X-Production-Ready-Reason") or "image is untrusted"
-    raise PermanentError(message)
 
+def next_interval(interval: float):
+    '''
+    Start probing fast and back off to the maximum interval
 
-@retry("Docker run", max_tries=3, retry_delay=5)
-def start_docker(cmd):
-    return subprocess.check_output(cmd).decode('utf-8').strip()
+    >>> next_interval(HEALTH_CHECK_MIN_INTERVAL)
+    0.2
+    >>> next_interval(HEALTH_CHECK_MAX_INTERVAL)
+    2
+    '''
+    return min(interval * 2, HEALTH_CHECK_MAX_INTERVAL)
 
 
-def run_docker(cmd, dry_run):
-    if not args.dry_run:
-        container_id = start_docker(cmd)
-        logging.info('Container {} is running'.format(container_id))
+def write_health_check_metrics(time_to_listen, time_to_healthy, probes: int):
+    try:
+        labels = {'hostname': socket.gethostname()}
+        lines = ['# HELP taupage_app_time_to_listen_seconds Time from container start until the health check port '
+                 'was listening (-1 if never seen)',
+                 '# TYPE taupage_app_time_to_listen_seconds gauge',
+                 format_metric('taupage_app_time_to_listen_seconds', labels, time_to_listen),
+                 '# HELP taupage_app_time_to_healthy_seconds Time from container start until the health check '
+                 'returned OK (-1 on timeout)',
+                 '# TYPE taupage_app_time_to_healthy_seconds gauge',
+                 format_metric('taupage_app_time_to_healthy_seconds', labels, time_to_healthy),
+                 '# HELP taupage_app_health_check_probes Number of HTTP health check probes until healthy',
+                 '# TYPE taupage_app_health_check_probes gauge',
+                 format_metric('taupage_app_health_check_probes', labels, probes)]
+        write_textfile(HEALTH_CHECK_PROM_FILE, lines)
+    except Exception as e:
+        logging.warning('Could not write health check metrics: %s', e)
 
 
 def wait_for_health_check(config: dict):
@@ -389,21 +404,47 @@ def wait_for_health_check(config: dict):
     url = 'http://localhost:{}{}'.format(health_check_port, health_check_path)
 
     start = time.time()
-    while time.time() < start + health_check_timeout_seconds:
-        logging.info('Waiting for health check :{}{}..'.format(health_check_port, health_check_path))
-        try:
-            response = requests.get(url, timeout=5)
-            if response.status_code == 200:
-                logging.info('Health check returned OK')
-                return
-        except Exception:
-            pass
+    deadline = start + health_check_timeout_seconds
+    time_to_listen = -1
+    probes = 0
+    with boot_phase('wait_for_health_check'):
+        # first wait for the port to be opened, this is cheap and can be checked often
+        logging.info('Waiting for port {} to be opened..'.format(health_check_port))
+        interval = HEALTH_CHECK_MIN_INTERVAL
+        port_deadline = min(deadline, start + HEALTH_CHECK_PORT_WAIT_SECONDS)
+        while time.time() < port_deadline:
+            if is_port_open(integer_port(health_check_port)):
+                time_to_listen = time.time() - start
+                break
+            time.sleep(interval)
+            interval = next_interval(interval)
+        else:
+            logging.info('Port {} does not seem to be open yet, probing via HTTP anyway'.format(health_check_port))
+
+        # then probe via HTTP over a keep-alive connection
+        session = requests.Session()
+        interval = HEALTH_CHECK_MIN_INTERVAL
+        while time.time() < deadline:
+            if probes == 0 or interval >= HEALTH_CHECK_MAX_INTERVAL:
+                logging.info('Waiting for health check :{}{}..'.format(health_check_port, health_check_path))
+            probes += 1
+            try:
+                response = session.get(url, timeout=max(min(5, deadline - time.time()), 0.1))
+                if response.status_code == 200:
+                    time_to_healthy = time.time() - start
+                    logging.info('Health check returned OK after {:.1f} seconds'.format(time_to_healthy))
+                    write_health_check_metrics(time_to_listen, time_to_healthy, probes)
+                    return
+            except Exception:
+                pass
 
-        time.sleep(2)
+            time.sleep(interval)
+            interval = next_interval(interval)
 
-    logging.error('Timeout of {}s expired for health check :{}{}'.format(
-        health_check_timeout_seconds, health_check_port, health_check_path))
-    sys.exit(2)
+        logging.error('Timeout of {}s expired for health check :{}{}'.format(
+            health_check_timeout_seconds, health_check_port, health_check_path))
+        write_health_check_metrics(time_to_listen, -1, probes)
+        sys.exit(2)
 
 
 def parse_image_tag(source):
@@ -465,9 +506,100 @@ def parse_image_tag(source):
     return registry, org, name, tag
 
 
+def container_exists(docker_cmd: str):
+    try:
+        cmd = [docker_cmd, 'ps', '-a', '-q', '-f', 'name=taupageapp']
+        return bool(subprocess.check_output(cmd))
+    except Exception as e:
+        logging.error("Failed to list existing docker containers: %s", str(e))
+        # not a fatal error, continue
+        return False
+
+
+def can_prefetch(config: dict):
+    '''
+    The image can only be pulled before the disks are prepared if they do not replace Docker's storage
+
+    >>> can_prefetch({'mounts': {'/data': {}}})
+    True
+
+    >>> can_prefetch({'mounts': {'/var/lib/docker': {}}})
+    False
+
+    >>> can_prefetch({'mounts': {'/var': {}}})
+    False
+    '''
+    for mountpoint in config.get('mounts') or {}:
+        mountpoint = os.path.normpath(str(mountpoint))
+        if os.path.commonpath([mountpoint, DOCKER_DATA_DIR]) in (mountpoint, DOCKER_DATA_DIR):
+            return False
+    return True
+
+
+def write_prefetch_result(result: dict):
+    os.makedirs(os.path.dirname(PREFETCH_RESULT_FILE), mode=0o700, exist_ok=True)
+    atomic_write(PREFETCH_RESULT_FILE, json.dumps(result))
+
+
+def prefetch_image(config: dict, client: RegistryClient, org: str, name: str, tag: str):
+    '''
+    Log in, verify and pull the image while the init scripts are still running
+
+    The init script takes the lock before starting the prefetch in the
+    background (the prefetch inherits it), so the runtime always waits
+    for the prefetch to finish before starting the container.
+    '''
+    source = config['source']
+    result = {'source': source, 'verified': False, 'pulled': False}
+    try:
+        with boot_phase('registry_login', source='prefetch'):
+            client.login()
+        with boot_phase('verify_image_trusted', source='prefetch'):
+            client.verify_trusted(org, name, tag)
+        result['verified'] = True
+        logging.info('Pulling Docker image {}'.format(source))
+        with boot_phase('docker_pull', source='prefetch'):
+            run_command([get_docker_command(config), 'pull', source], check=True, capture_stderr=False)
+        result['pulled'] = True
+    except Exception as e:
+        # the runtime will do it again and fail properly
+        logging.warning('Prefetching Docker image failed: %s', e)
+    write_prefetch_result(result)
+    logging.info('Prefetching Docker image {} finished: {}'.format(source, result))
+
+
+def read_prefetch_result():
+    try:
+        if is_trusted_file(PREFETCH_RESULT_FILE):
+            with open(PREFETCH_RESULT_FILE) as fd:
+                return json.load(fd)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logging.debug('Could not read image prefetch result: %s', e)
+    return None
+
+
+def wait_for_prefetch(source: str):
+    '''
+    Wait for the image prefetch started by the init script and return its result,
+    an empty dict if there is none for this image
+    '''
+    if not os.path.exists(PREFETCH_LOCK_FILE):
+        return {}
+    with boot_phase('wait_for_prefetch'):
+        with open(PREFETCH_LOCK_FILE) as lock:
+            # held from before the prefetch starts until it exits
+            fcntl.flock(lock, fcntl.LOCK_SH)
+        result = read_prefetch_result()
+    if result is None:
+        logging.warning('Image prefetch finished without a result')
+        return {}
+    return result if result.get('source') == source else {}
+
+
 def main(args):
-    with open(args.config) as fd:
-        config = yaml.safe_load(fd)
+    config = get_config(args.config)
 
     source = config['source']
 
@@ -479,31 +611,40 @@ def main(args):
 
     docker_cmd = get_docker_command(config)
 
-    already_exists = False
-    try:
-        cmd = [docker_cmd, 'ps', '-a', '-q', '-f', 'name=taupageapp']
-        if subprocess.check_output(cmd):
-            already_exists = True
-    except Exception as e:
-        logging.error("Failed to list existing docker containers: %s", str(e))
-        # not a fatal error, continue
+    already_exists = container_exists(docker_cmd)
+
+    if args.prefetch:
+        if already_exists or not can_prefetch(config):
+            logging.info('Not prefetching Docker image {}'.format(source))
+            write_prefetch_result({'source': source, 'verified': False, 'pulled': False, 'skipped': True})
+        else:
+            prefetch_image(config, RegistryClient(registry), org, name, tag)
+        return
 
     if already_exists:
         try:
             cmd = [docker_cmd, 'start', 'taupageapp']
             logging.info('Starting existing Docker container: {}'.format(cmd))
             if not args.dry_run:
-                subprocess.check_output(cmd)
+                with boot_phase('docker_start'):
+                    run_command(cmd, check=True, capture_stderr=False)
         except Exception as e:
             logging.error('Docker start of existing container failed: %s', str(e))
             sys.exit(1)
     else:
-        registry_login(config, registry)
-        try:
-            verify_image_trusted(registry, org, name, tag)
-        except Exception as e:
-            logging.error("Trusted image check failed: %s", e)
-            sys.exit(1)
+        prefetched = wait_for_prefetch(source)
+        if prefetched.get('verified'):
+            logging.info('Using prefetched Docker image {} (pulled: {})'.format(source, prefetched.get('pulled')))
+        else:
+            client = RegistryClient(registry)
+            with boot_phase('registry_login'):
+                client.login()
+            try:
+                with boot_phase('verify_image_trusted'):
+                    client.verify_trusted(org, name, tag)
+            except Exception as e:
+                logging.error("Trusted image check failed: %s", e)
+                sys.exit(1)
 
         cmd = [docker_cmd, 'run', '-d', '--log-driver=syslog', '--name=taupageapp', '--restart=on-failure:10']
         for f in get_env_options, get_volume_options, get_port_options, get_other_options:
@@ -526,6 +667,8 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--config', '-c', help='Config file', default='/meta/taupage.yaml')
     parser.add_argument('--dry-run', help='Print what would be done', action='store_true')
+    parser.add_argument('--prefetch', help='Only verify and pull the image (while init is running)',
+                        action='store_true')
     args = parser.parse_args()
     logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
     logging.getLogger("urllib3.connectionpool").setLevel(logging.WARN)
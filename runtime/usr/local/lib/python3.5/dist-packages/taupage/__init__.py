@@ -2,14 +2,37 @@
 Taupage base module with helper functions
 '''
 
+import copy
+import hashlib
+import json
 import logging
+import os
+import requests
+import stat
+import threading
+import time
 import yaml
 
-from boto.utils import get_instance_metadata
-
 
 TAUPAGE_CONFIG_PATH = '/meta/taupage.yaml'
 CREDENTIALS_DIR = '/meta/credentials'
+CONFIG_CACHE_DIR = '/run/taupage/config-cache'
+
+# in-process memo of parsed configs: path -> (cache key, config)
+_config_memo = {}
+# JSON object holding a dict with keys that are not strings (e.g. port numbers)
+CONFIG_ITEMS_KEY = '__items__'
+
+METADATA_URL = 'http://169.254.169.254/latest/'
+METADATA_CACHE_FILE = '/run/taupage/instance-metadata.json'
+METADATA_TOKEN_TTL_SECONDS = 21600
+METADATA_TIMEOUT_SECONDS = 2
+METADATA_MAX_TRIES = 5
+
+_metadata_lock = threading.RLock()
+_metadata_session = None
+# in-process metadata cache, see load_metadata_cache()
+_metadata_cache = None
 
 
 def get_first(iterable, default=None):
@@ -118,10 +141,124 @@ def mask_dictionary(d: dict):
     return masked_dict
 
 
-def get_config(filename=TAUPAGE_CONFIG_PATH):
-    with open(filename) as fd:
-        config = yaml.safe_load(fd)
-    return config
+def get_config_cache_key(st: os.stat_result, data: bytes):
+    return '{}:{}:{}'.format(st.st_mtime_ns, st.st_size, hashlib.sha256(data).hexdigest())
+
+
+def get_config_snapshot_path(filename, cache_dir=CONFIG_CACHE_DIR):
+    path_hash = hashlib.sha256(os.path.abspath(filename).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, '{}.json'.format(path_hash[:16]))
+
+
+def encode_config(value):
+    '''
+    Convert a parsed YAML document into JSON data, dicts with non-string keys become lists of items
+
+    Raises TypeError for values JSON cannot represent (e.g. dates), such configs are not snapshotted.
+
+    >>> encode_config({'ports': {80: 8080}, 'a': [1, None]}) == {'ports': {'__items__': [[80, 8080]]}, 'a': [1, None]}
+    True
+    '''
+    if isinstance(value, dict):
+        if all(isinstance(k, str) for k in value) and CONFIG_ITEMS_KEY not in value:
+            return {k: encode_config(v) for k, v in value.items()}
+        return {CONFIG_ITEMS_KEY: [[encode_config(k), encode_config(v)] for k, v in value.items()]}
+    if isinstance(value, list):
+        return [encode_config(v) for v in value]
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    raise TypeError('{} values can not be stored as JSON'.format(type(value).__name__))
+
+
+def decode_config_object(obj: dict):
+    '''
+    >>> json.loads('{"ports": {"__items__": [[80, 8080]]}}', object_hook=decode_config_object)
+    {'ports': {80: 8080}}
+    '''
+    if set(obj) == {CONFIG_ITEMS_KEY}:
+        return {k: v for k, v in obj[CONFIG_ITEMS_KEY]}
+    return obj
+
+
+def atomic_write(path: str, data, mode=0o600):
+    '''
+    Write data (str or bytes) to a temporary file and rename it to path,
+    so readers never see a partially written file
+
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'test.json')
+    >>> atomic_write(path, '{}', mode=0o644)
+    >>> open(path).read(), oct(os.stat(path).st_mode & 0o777)
+    ('{}', '0o644')
+    '''
+    tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+    try:
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+        with open(fd, 'wb' if isinstance(data, bytes) else 'w') as f:
+            f.write(data)
+        # the mode of open() is subject to the umask
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def is_trusted_file(path):
+    '''Only load snapshots nobody else could have tampered with'''
+    st = os.stat(path)
+    return st.st_uid in (0, os.getuid()) and not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+
+def read_config_snapshot(path, key):
+    '''Return the config of the snapshot if it has the given key (its "config" might be None) or None'''
+    try:
+        if is_trusted_file(path):
+            with open(path) as fd:
+                snapshot = json.load(fd, object_hook=decode_config_object)
+            if snapshot.get('key') == key:
+                return snapshot
+    except Exception as e:
+        logging.debug('Could not read config snapshot %s: %s', path, e)
+    return None
+
+
+def write_config_snapshot(path, key, config):
+    try:
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        atomic_write(path, json.dumps({'key': key, 'config': encode_config(config)}))
+    except Exception as e:
+        logging.debug('Could not write config snapshot %s: %s', path, e)
+
+
+def get_config(filename=TAUPAGE_CONFIG_PATH, cache_dir=CONFIG_CACHE_DIR):
+    '''
+    Return the parsed Taupage config
+
+    Parsing YAML is slow, so the parsed config is kept in memory and as
+    snapshot in the cache dir to share it between all boot scripts.
+    Both are keyed by the file's mtime, size and SHA-256 hash.
+    Every call returns a fresh copy, so callers can modify it.
+    '''
+    with open(filename, 'rb') as fd:
+        data = fd.read()
+        key = get_config_cache_key(os.fstat(fd.fileno()), data)
+
+    path = os.path.abspath(filename)
+    memo_key, config = _config_memo.get(path, (None, None))
+    if memo_key != key:
+        snapshot_path = get_config_snapshot_path(path, cache_dir)
+        snapshot = read_config_snapshot(snapshot_path, key)
+        if snapshot is not None:
+            config = snapshot['config']
+        else:
+            config = yaml.safe_load(data)
+            write_config_snapshot(snapshot_path, key, config)
+        _config_memo[path] = (key, config)
+    return copy.deepcopy(config)
 
 
 def get_boot_time():
@@ -134,9 +271,117 @@ def get_boot_time():
     return boot_time
 
 
+def load_metadata_cache():
+    '''
+    Return the instance metadata cache: fetched values and the IMDSv2 token
+
+    Metadata does not change during the lifetime of a boot, so it is kept
+    in memory and in a file below /run (which is cleared on reboot) to
+    share it between all boot scripts.
+    '''
+    global _metadata_cache
+    if _metadata_cache is None:
+        _metadata_cache = {'values': {}, 'token': None, 'token_expires': 0}
+        try:
+            if is_trusted_file(METADATA_CACHE_FILE):
+                with open(METADATA_CACHE_FILE) as fd:
+                    _metadata_cache.update(json.load(fd))
+        except Exception as e:
+            logging.debug('Could not read instance metadata cache: %s', e)
+    return _metadata_cache
+
+
+def save_metadata_cache():
+    try:
+        # merge with values fetched by other (parallel) boot scripts in the meantime
+        if os.path.exists(METADATA_CACHE_FILE) and is_trusted_file(METADATA_CACHE_FILE):
+            with open(METADATA_CACHE_FILE) as fd:
+                values = json.load(fd).get('values', {})
+            values.update(_metadata_cache['values'])
+            _metadata_cache['values'] = values
+        os.makedirs(os.path.dirname(METADATA_CACHE_FILE), mode=0o700, exist_ok=True)
+        atomic_write(METADATA_CACHE_FILE, json.dumps(_metadata_cache))
+    except Exception as e:
+        logging.debug('Could not write instance metadata cache: %s', e)
+
+
+def get_metadata_session():
+    global _metadata_session
+    if _metadata_session is None:
+        _metadata_session = requests.Session()
+    return _metadata_session
+
+
+def get_metadata_token():
+    '''Return a (reused) IMDSv2 session token or None to fall back to IMDSv1'''
+    cache = load_metadata_cache()
+    # renew the token well before it expires
+    if cache['token'] and cache['token_expires'] > time.time() + 60:
+        return cache['token']
+    try:
+        response = get_metadata_session().put(
+            METADATA_URL + 'api/token', timeout=METADATA_TIMEOUT_SECONDS,
+            headers={'X-aws-ec2-metadata-token-ttl-seconds': str(METADATA_TOKEN_TTL_SECONDS)})
+        response.raise_for_status()
+    except Exception as e:
+        logging.debug('Could not get IMDSv2 token, falling back to IMDSv1: %s', e)
+        return None
+    cache['token'] = response.text
+    cache['token_expires'] = time.time() + METADATA_TOKEN_TTL_SECONDS
+    return cache['token']
+
+
+def fetch_metadata(path: str):
+    '''Fetch a value from the instance metadata service, return None if it does not exist'''
+    for attempt in range(1, METADATA_MAX_TRIES + 1):
+        token = get_metadata_token()
+        headers = {'X-aws-ec2-metadata-token': token} if token else {}
+        try:
+            response = get_metadata_session().get(METADATA_URL + path, headers=headers,
+                                                  timeout=METADATA_TIMEOUT_SECONDS)
+            if response.status_code == 404:
+                return None
+            if response.status_code == 401:
+                # token expired or got invalid
+                load_metadata_cache()['token'] = None
+            response.raise_for_status()
+            return response.text
+        except Exception:
+            if attempt >= METADATA_MAX_TRIES:
+                raise
+            time.sleep(0.1 * 2 ** attempt)
+
+
+def get_cached_metadata(path: str):
+    with _metadata_lock:
+        values = load_metadata_cache()['values']
+        if path not in values:
+            values[path] = fetch_metadata(path)
+            save_metadata_cache()
+        return values[path]
+
+
+def get_metadata(path: str):
+    '''
+    Return a value of the instance metadata, e.g. "placement/availability-zone"
+
+    Values are only fetched once per boot, None is returned for non-existing values.
+    '''
+    return get_cached_metadata('meta-data/' + path)
+
+
+def get_instance_identity():
+    '''Return the instance identity document (region, accountId, instanceId, ...)'''
+    return json.loads(get_cached_metadata('dynamic/instance-identity/document'))
+
+
 def get_instance_id():
-    return get_instance_metadata().get('instance-id')
+    return get_instance_identity()['instanceId']
+
+
+def get_availability_zone():
+    return get_instance_identity()['availabilityZone']
 
 
 def get_region():
-    return get_instance_metadata().get('placement')['availability-zone'][:-1]
+    return get_instance_identity()['region']
@@ -0,0 +1,269 @@
+'''
+KMS decryption of "aws:kms:" values with a local cache of plaintexts
+
+Values are decrypted in batches, concurrently over one KMS client.
+Decrypting the same values again on every run of the runtime and of
+the logging configurators costs KMS round-trips and runs into throttling
+during fleet-wide rollouts. Plaintexts are therefore cached on tmpfs
+(/run), named by a keyed hash of the ciphertext.
+
+Entries are encrypted with AES-GCM (the "cryptography" package). The key
+is created once per boot and only kept in the kernel keyring of root,
+never in a file, so the entries (and the ciphertexts in taupage.yaml)
+alone do not reveal any plaintext. The key is gone after a reboot, the
+cache therefore only lives as long as the current boot. Without the
+keyring or the cryptography package, nothing is cached.
+'''
+
+import base64
+import boto3
+import botocore.config
+import botocore.exceptions
+import hashlib
+import hmac
+import json
+import logging
+import os
+import subprocess
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from taupage import atomic_write, get_region, is_trusted_file
+
+try:
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+except ImportError:
+    AESGCM = None
+
+AWS_KMS_PREFIX = 'aws:kms:'
+KMS_MAX_WORKERS = 8
+KMS_MAX_TRIES = 10
+KMS_THROTTLING_ERRORS = ('Throttling', 'ThrottlingException', 'RequestLimitExceeded')
+
+KMS_CACHE_DIR = '/run/taupage/kms-cache'
+KMS_CACHE_TTL_SECONDS = 24 * 3600
+KMS_CACHE_MAX_ENTRIES = 256
+# description of the cache key in the user keyring of root
+KMS_CACHE_KEY_DESCRIPTION = 'taupage:kms-cache'
+
+ENTRY_SUFFIX = '.entry'
+NONCE_SIZE = 12
+
+
+def get_keyring_key(description=KMS_CACHE_KEY_DESCRIPTION):
+    '''Return the 256 bit key from the user keyring, create it if it does not exist yet'''
+    try:
+        key_id = subprocess.check_output(['keyctl', 'search', '@u', 'user', description],
+                                         stderr=subprocess.DEVNULL).strip()
+    except subprocess.CalledProcessError:
+        key_id = subprocess.check_output(['keyctl', 'padd', 'user', description, '@u'],
+                                         input=os.urandom(32)).strip()
+        # only readable by root (possessor and user), also from other sessions
+        subprocess.check_call(['keyctl', 'setperm', key_id, '0x3f3f0000'])
+    key = subprocess.check_output(['keyctl', 'pipe', key_id])
+    if len(key) != 32:
+        raise ValueError('Invalid KMS cache key in keyring')
+    return key
+
+
+class SecretCache:
+    '''Encrypted cache of KMS plaintexts with TTL and eviction of the oldest entries'''
+
+    def __init__(self, directory=KMS_CACHE_DIR, ttl=KMS_CACHE_TTL_SECONDS, max_entries=KMS_CACHE_MAX_ENTRIES):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._key = None
+        self._key_error = None
+
+    def key(self):
+        # only try the keyring once, without it every lookup is a cache miss
+        if self._key is None and self._key_error is None:
+            try:
+                if AESGCM is None:
+                    raise RuntimeError('cryptography package is not installed')
+                self._key = get_keyring_key()
+            except Exception as e:
+                self._key_error = e
+        if self._key_error is not None:
+            raise RuntimeError('KMS cache is not available: {}'.format(self._key_error))
+        return self._key
+
+    def entry_name(self, ciphertext: str):
+        return hmac.new(self.key(), ciphertext.encode('utf-8'), hashlib.sha256).hexdigest()
+
+    def get(self, ciphertext: str):
+        '''Return the cached plaintext for the (base64 encoded) ciphertext or None'''
+        try:
+            name = self.entry_name(ciphertext)
+            path = os.path.join(self.directory, name + ENTRY_SUFFIX)
+            if not is_trusted_file(path):
+                logging.warning('Ignoring KMS cache entry %s writable by others', path)
+                return None
+            with open(path, 'rb') as f:
+                data = f.read()
+            # the entry name is authenticated, so an entry can not be used for another ciphertext
+            entry = json.loads(AESGCM(self.key()).decrypt(data[:NONCE_SIZE], data[NONCE_SIZE:],
+                                                          name.encode('utf-8')).decode('utf-8'))
+            if entry['expires'] < time.time():
+                os.remove(path)
+                return None
+            return entry['plaintext']
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            # e.g. no keyring or an entry encrypted with the key of another boot
+            logging.debug('Could not read KMS cache: %s', e)
+            return None
+
+    def put(self, ciphertext: str, plaintext: str):
+        try:
+            name = self.entry_name(ciphertext)
+            entry = json.dumps({'plaintext': plaintext, 'expires': int(time.time() + self.ttl)})
+            nonce = os.urandom(NONCE_SIZE)
+            data = nonce + AESGCM(self.key()).encrypt(nonce, entry.encode('utf-8'), name.encode('utf-8'))
+            os.makedirs(self.directory, mode=0o700, exist_ok=True)
+            atomic_write(os.path.join(self.directory, name + ENTRY_SUFFIX), data)
+            self.evict()
+        except Exception as e:
+            logging.debug('Could not write KMS cache: %s', e)
+
+    def evict(self):
+        '''Remove expired entries and the oldest entries exceeding the maximum number of entries'''
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(ENTRY_SUFFIX):
+                path = os.path.join(self.directory, name)
+                try:
+                    entries.append((os.stat(path).st_mtime, path))
+                except FileNotFoundError:
+                    pass
+        entries.sort(reverse=True)
+        for i, (mtime, path) in enumerate(entries):
+            if i >= self.max_entries or mtime + self.ttl < time.time():
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+
+class KmsDecrypter:
+    '''
+    Decrypt KMS ciphertexts concurrently over one (thread-safe) KMS client
+
+    Throttling of any request makes all workers back off together.
+    '''
+
+    def __init__(self, region=None, max_workers=KMS_MAX_WORKERS):
+        self.max_workers = max_workers
+        self.client = boto3.client('kms', region_name=region or get_region(),
+                                   config=botocore.config.Config(max_pool_connections=max_workers))
+        self.lock = threading.Lock()
+        self.not_before = 0
+
+    def wait_for_backoff(self):
+        with self.lock:
+            delay = self.not_before - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+    def backoff(self, attempt):
+        with self.lock:
+            self.not_before = max(self.not_before, time.time() + 2 ** attempt * 0.5)
+
+    def decrypt(self, ciphertext):
+        ciphertext_blob = base64.b64decode(ciphertext)
+        attempt = 0
+        while True:
+            self.wait_for_backoff()
+            try:
+                data = self.client.decrypt(CiphertextBlob=ciphertext_blob)
+                break
+            except botocore.exceptions.ClientError as e:
+                if attempt >= KMS_MAX_TRIES or e.response.get('Error', {}).get('Code') not in KMS_THROTTLING_ERRORS:
+                    raise
+                logging.info('Throttling AWS API requests...')
+                self.backoff(attempt)
+                attempt += 1
+
+        if 'Plaintext' not in data:
+            raise Exception('KMS decrypt failed')
+        return data['Plaintext'].decode('utf-8')
+
+    def decrypt_all(self, ciphertexts):
+        '''Decrypt all given ciphertexts, return a dict ciphertext -> plaintext'''
+        ciphertexts = sorted(set(ciphertexts))
+        if not ciphertexts:
+            return {}
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(ciphertexts))) as executor:
+            return dict(zip(ciphertexts, executor.map(self.decrypt, ciphertexts)))
+
+
+def decrypt_ciphertexts(ciphertexts, region=None, cache=None):
+    '''
+    Decrypt base64 encoded KMS ciphertexts, return a dict ciphertext -> plaintext
+
+    Identical ciphertexts are only decrypted once, plaintexts are taken
+    from the local secret cache if possible.
+
+    >>> decrypt_ciphertexts([])
+    {}
+    '''
+    ciphertexts = set(ciphertexts)
+    if not ciphertexts:
+        return {}
+
+    cache = cache or SecretCache()
+    plaintexts = {}
+    for ciphertext in ciphertexts:
+        plaintext = cache.get(ciphertext)
+        if plaintext is not None:
+            plaintexts[ciphertext] = plaintext
+
+    missing = ciphertexts - plaintexts.keys()
+    if missing:
+        logging.info('Decrypting {} KMS encrypted values ({} cached)'.format(len(missing), len(plaintexts)))
+        for ciphertext, plaintext in KmsDecrypter(region).decrypt_all(missing).items():
+            cache.put(ciphertext, plaintext)
+            plaintexts[ciphertext] = plaintext
+    return plaintexts
+
+
+def is_kms_encrypted(val):
+    '''
+    >>> is_kms_encrypted('aws:kms:abc')
+    True
+
+    >>> is_kms_encrypted(123)
+    False
+    '''
+    return isinstance(val, str) and val.startswith(AWS_KMS_PREFIX)
+
+
+def decrypt_values(values, region=None):
+    '''
+    Decrypt all "aws:kms:" values, return a dict encrypted value -> plaintext
+
+    >>> decrypt_values([True, 'test'])
+    {}
+    '''
+    ciphertexts = [val[len(AWS_KMS_PREFIX):] for val in values if is_kms_encrypted(val)]
+    plaintexts = decrypt_ciphertexts(ciphertexts, region)
+    return {AWS_KMS_PREFIX + ciphertext: plaintext for ciphertext, plaintext in plaintexts.items()}
+
+
+def decrypt(val, region=None):
+    '''
+    Decrypt a single value if it is KMS encrypted
+
+    >>> decrypt(True)
+    True
+
+    >>> decrypt('test')
+    'test'
+    '''
+    if is_kms_encrypted(val):
+        return decrypt_values([val], region)[val]
+    else:
+        return val
@@ -0,0 +1,206 @@
+'''
+Docker registry client used to log in and to verify that images are trusted
+
+All requests to a registry go over one pooled HTTP session and are retried
+with jittered exponential backoff, so instances deployed at the same time
+do not hammer a slow registry in lockstep.
+
+Positive trust results are cached in /var/cache/taupage keyed by image tag,
+recording the manifest digest: restarts and reboots of the same image do not
+talk to the registry at all. Entries expire after a day, so a re-pushed tag
+or withdrawn trust is picked up by the next verification after that.
+'''
+
+import base64
+import json
+import logging
+import os
+import random
+import requests
+import threading
+import time
+
+from taupage import atomic_write, get_cached_metadata, is_trusted_file
+
+PIERONE_REGISTRY = 'pierone.stups.zalan.do'
+
+REGISTRY_CONNECT_TIMEOUT_SECONDS = 5
+REGISTRY_READ_TIMEOUT_SECONDS = 30
+REGISTRY_MAX_TRIES = 5
+REGISTRY_BACKOFF_BASE_SECONDS = 1
+REGISTRY_BACKOFF_MAX_SECONDS = 30
+
+TRUST_CACHE_FILE = '/var/cache/taupage/registry-trust.json'
+TRUST_CACHE_TTL_SECONDS = 24 * 3600
+TRUST_CACHE_MAX_ENTRIES = 100
+
+DOCKER_CONFIG_FILE = '~/.docker/config.json'
+
+# ask for the same manifest (and therefore digest) Docker pulls
+MANIFEST_ACCEPT = ', '.join(['application/vnd.docker.distribution.manifest.list.v2+json',
+                             'application/vnd.docker.distribution.manifest.v2+json',
+                             'application/vnd.docker.distribution.manifest.v1+prettyjws'])
+
+
+class UntrustedImageError(Exception):
+    '''The registry does not consider the image production ready, retrying will not help'''
+
+
+def backoff_delay(attempt: int, base=REGISTRY_BACKOFF_BASE_SECONDS, cap=REGISTRY_BACKOFF_MAX_SECONDS):
+    '''
+    Return the delay before the next attempt ("full jitter" exponential backoff)
+
+    >>> 0 <= backoff_delay(1) <= 2
+    True
+
+    >>> 0 <= backoff_delay(20) <= REGISTRY_BACKOFF_MAX_SECONDS
+    True
+    '''
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def is_retryable(e: Exception):
+    '''
+    Connection problems, timeouts, throttling and server errors are worth another try
+
+    >>> is_retryable(requests.exceptions.ConnectionError())
+    True
+
+    >>> is_retryable(UntrustedImageError('no'))
+    False
+    '''
+    if isinstance(e, requests.exceptions.HTTPError) and e.response is not None:
+        return e.response.status_code == 429 or e.response.status_code >= 500
+    return isinstance(e, requests.exceptions.RequestException)
+
+
+class TrustCache:
+    '''Persistent cache of positive trust results'''
+
+    def __init__(self, path=TRUST_CACHE_FILE, ttl=TRUST_CACHE_TTL_SECONDS, max_entries=TRUST_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+
+    def load(self):
+        try:
+            if is_trusted_file(self.path):
+                with open(self.path) as fd:
+                    entries = json.load(fd)
+                if isinstance(entries, dict):
+                    return entries
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.debug('Could not read registry trust cache: %s', e)
+        return {}
+
+    def get(self, image: str):
+        '''Return the cached entry (with "verified" timestamp and "digest") of the image ("name:tag") or None'''
+        with self.lock:
+            entry = self.load().get(image)
+        if entry and entry.get('verified', 0) + self.ttl > time.time():
+            return entry
+        return None
+
+    def put(self, image: str, digest: str):
+        with self.lock:
+            entries = self.load()
+            entries[image] = {'verified': time.time(), 'digest': digest}
+            newest = sorted(entries.items(), key=lambda item: item[1].get('verified', 0), reverse=True)
+            entries = dict(newest[:self.max_entries])
+            try:
+                os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+                atomic_write(self.path, json.dumps(entries, indent=2, sort_keys=True))
+            except Exception as e:
+                logging.debug('Could not write registry trust cache: %s', e)
+
+
+class RegistryClient:
+    '''
+    Client for one Docker registry, authenticating with the instance identity for Pier One
+
+    >>> RegistryClient('registry.example.org').requires_auth
+    False
+    '''
+
+    def __init__(self, registry: str, trust_cache: TrustCache = None, max_tries=REGISTRY_MAX_TRIES):
+        self.registry = registry
+        self.requires_auth = registry == PIERONE_REGISTRY
+        self.trust_cache = trust_cache or TrustCache()
+        self.max_tries = max_tries
+        self.session = requests.Session()
+        self._auth = None
+
+    @property
+    def url(self):
+        return 'https://{}'.format(self.registry)
+
+    def auth(self):
+        '''Return the instance identity document encoded as Pier One auth token (fetched only once)'''
+        if self._auth is None:
+            pkcs7 = get_cached_metadata('dynamic/instance-identity/pkcs7')
+            basic_auth = 'instance-identity-document:{}'.format(pkcs7).encode('utf-8')
+            self._auth = base64.b64encode(basic_auth).decode('utf-8')
+        return self._auth
+
+    def with_retries(self, name: str, fn, *args):
+        attempt = 1
+        while True:
+            try:
+                return fn(*args)
+            except Exception as e:
+                if attempt >= self.max_tries or not is_retryable(e):
+                    raise
+                delay = backoff_delay(attempt)
+                logging.warning('{} failed (try {}/{}), retrying in {:.1f}s: {}'.format(
+                    name, attempt, self.max_tries, delay, e))
+                attempt += 1
+                time.sleep(delay)
+
+    def login(self):
+        '''Configure the Docker client to authenticate against the registry'''
+        if not self.requires_auth:
+            return
+        path = os.path.expanduser(DOCKER_CONFIG_FILE)
+        try:
+            with open(path) as fd:
+                docker_config = json.load(fd)
+        except Exception:
+            docker_config = {}
+        docker_config.setdefault('auths', {})[self.url] = {'auth': self.auth(),
+                                                           'email': 'no-mail-required@example.org'}
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        atomic_write(path, json.dumps(docker_config, indent=2), mode=0o600)
+
+    def headers(self):
+        headers = {'Accept': MANIFEST_ACCEPT}
+        if self.requires_auth:
+            headers['Authorization'] = 'Basic {}'.format(self.auth())
+        return headers
+
+    def manifest_url(self, org: str, name: str, tag: str):
+        return '{}/v2/{}/{}/manifests/{}'.format(self.url, org, name, tag)
+
+    def fetch_trust(self, org: str, name: str, tag: str):
+        response = self.session.get(self.manifest_url(org, name, tag), headers=self.headers(),
+                                    timeout=(REGISTRY_CONNECT_TIMEOUT_SECONDS, REGISTRY_READ_TIMEOUT_SECONDS))
+        response.raise_for_status()
+
+        ready = response.headers.get('X-Production-Ready-Taupage') or response.headers.get('X-Trusted')
+        if ready != 'true':
+            raise UntrustedImageError(response.headers.get('X-Production-Ready-Reason') or 'image is untrusted')
+        return response.headers.get('Docker-Content-Digest')
+
+    def verify_trusted(self, org: str, name: str, tag: str):
+        '''Raise an exception if the image is not trusted, return its manifest digest (if known)'''
+        image = '{}/{}/{}:{}'.format(self.registry, org, name, tag)
+        entry = self.trust_cache.get(image)
+        if entry:
+            logging.info('Image {} ({}) was verified as trusted before'.format(image, entry.get('digest')))
+            return entry.get('digest')
+
+        digest = self.with_retries('verifying trusted image', self.fetch_trust, org, name, tag)
+        self.trust_cache.put(image, digest)
+        return digest
@@ -0,0 +1,252 @@
+'''
+Boot timeline: record start, end, exit code and wall/CPU time of boot steps
+
+Every step is appended as one JSON line to the timeline file, so all
+init scripts (running in parallel or not) and the runtime can contribute.
+The collected timeline is exported as JSON and as Prometheus textfile.
+
+The CPU time of a phase is the CPU time of its thread plus the CPU time of
+the commands it ran with run_command() (taken from their wait4() resource
+usage), so phases running in parallel threads do not include each other's
+child processes.
+'''
+
+import contextlib
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from taupage import atomic_write
+
+TIMELINE_FILE = '/run/taupage-init-ran/timeline.jsonl'
+TIMELINE_JSON_FILE = '/run/taupage-init-ran/timeline.json'
+TEXTFILE_COLLECTOR_DIR = '/var/local/textfile_collector'
+TIMELINE_PROM_FILE = 'taupage_boot_timeline.prom'
+
+# CPU time of the child processes run by the boot phases active in the current thread
+_phases = threading.local()
+
+
+def thread_cpu_time():
+    '''Return the CPU time (user + system) used by the current thread'''
+    return time.clock_gettime(time.CLOCK_THREAD_CPUTIME_ID)
+
+
+def add_child_cpu_time(seconds: float):
+    '''Account the CPU time of a child process to all boot phases active in the current thread'''
+    for phase in getattr(_phases, 'active', []):
+        phase['children_cpu'] += seconds
+
+
+def run_command(args: list, check: bool = False, capture_stderr: bool = True, env: dict = None):
+    '''
+    Run a command, return its exit code, stdout and stderr (as bytes, None if not captured)
+
+    The command is reaped with wait4(), so its CPU time can be accounted
+    to the boot phases of the current thread.
+
+    >>> run_command(['sh', '-c', 'echo out; echo err >&2; exit 3'])
+    (3, b'out\\n', b'err\\n')
+
+    >>> try:
+    ...     run_command(['false'], check=True)
+    ... except subprocess.CalledProcessError as e:
+    ...     e.returncode
+    1
+    '''
+    # temporary files instead of pipes: wait4() must not block on a full pipe
+    with tempfile.TemporaryFile() as stdout, tempfile.TemporaryFile() as stderr:
+        proc = subprocess.Popen(args, stdout=stdout, stderr=stderr if capture_stderr else None, env=env)
+        _, status, rusage = os.wait4(proc.pid, 0)
+        if os.WIFSIGNALED(status):
+            proc.returncode = -os.WTERMSIG(status)
+        else:
+            proc.returncode = os.WEXITSTATUS(status)
+        add_child_cpu_time(rusage.ru_utime + rusage.ru_stime)
+        stdout.seek(0)
+        stderr.seek(0)
+        out, err = stdout.read(), stderr.read() if capture_stderr else None
+    if check and proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, args, out, err)
+    return proc.returncode, out, err
+
+
+def default_source():
+    return os.path.basename(sys.argv[0]) if sys.argv and sys.argv[0] else 'unknown'
+
+
+def record_step(name: str, start: float, end: float, exit_code: int, cpu_seconds: float,
+                source: str = None, target: str = None, reason: str = None, timeline_file=TIMELINE_FILE):
+    '''Append a boot step to the timeline (with the reason why it ran or was skipped, if known), never fails'''
+    step = {'name': name,
+            'source': source or default_source(),
+            'start': round(start, 3),
+            'end': round(end, 3),
+            'duration': round(end - start, 3),
+            'cpu': round(cpu_seconds, 3),
+            'exit_code': exit_code}
+    if target:
+        step['target'] = str(target)
+    if reason:
+        step['reason'] = str(reason)
+    if not os.path.isdir(os.path.dirname(timeline_file)):
+        # not running as part of Taupage init
+        return
+    try:
+        with open(timeline_file, 'a') as fd:
+            fd.write(json.dumps(step, sort_keys=True) + '\n')
+    except Exception as e:
+        logging.debug('Could not record boot step %s: %s', name, e)
+
+
+@contextlib.contextmanager
+def boot_phase(name: str, source: str = None, target: str = None, reason: str = None):
+    '''
+    Context manager to record a phase of a boot script
+
+    The exit code is 0 if the block finished normally, the exit code
+    for sys.exit() and 1 for any other exception. The block can set
+    the reason of the phase once it is known:
+
+    >>> with boot_phase('fsck_decision', target='/dev/xvdf') as phase:
+    ...     phase['reason'] = 'skipped: clean'
+    '''
+    start = time.time()
+    cpu_start = thread_cpu_time()
+    phase = {'children_cpu': 0, 'reason': reason}
+    if not hasattr(_phases, 'active'):
+        _phases.active = []
+    _phases.active.append(phase)
+    exit_code = 0
+    try:
+        yield phase
+    except SystemExit as e:
+        exit_code = e.code if isinstance(e.code, int) else int(e.code is not None)
+        raise
+    except BaseException:
+        exit_code = 1
+        raise
+    finally:
+        _phases.active.remove(phase)
+        cpu_seconds = thread_cpu_time() - cpu_start + phase['children_cpu']
+        record_step(name, start, time.time(), exit_code, cpu_seconds, source, target, phase['reason'])
+
+
+def read_timeline(timeline_file=TIMELINE_FILE):
+    '''Return all recorded steps ordered by their start time'''
+    steps = []
+    try:
+        with open(timeline_file) as fd:
+            for line in fd:
+                try:
+                    steps.append(json.loads(line))
+                except ValueError:
+                    # partially written line, ignore
+                    pass
+    except FileNotFoundError:
+        pass
+    return sorted(steps, key=lambda step: step['start'])
+
+
+def escape_label_value(value):
+    '''
+    >>> print(escape_label_value('say "hi"'))
+    say \\"hi\\"
+    '''
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels: dict):
+    '''
+    >>> format_labels({'step': 'mkfs', 'hostname': 'ip-1'})
+    '{hostname="ip-1",step="mkfs"}'
+    '''
+    return '{' + ','.join('{}="{}"'.format(k, escape_label_value(v)) for k, v in sorted(labels.items())) + '}'
+
+
+def format_metric(name: str, labels: dict, value):
+    '''
+    >>> format_metric('taupage_boot_duration_seconds', {'hostname': 'ip-1'}, 12.5)
+    'taupage_boot_duration_seconds{hostname="ip-1"} 12.500'
+    '''
+    return '{}{} {:.3f}'.format(name, format_labels(labels), value)
+
+
+def write_textfile(filename: str, lines: list, directory=TEXTFILE_COLLECTOR_DIR):
+    '''Atomically write a Prometheus textfile so the node exporter never reads partial files'''
+    atomic_write(os.path.join(directory, filename), '\n'.join(lines) + '\n', mode=0o644)
+
+
+STEP_METRICS = [
+    ('taupage_boot_step_start_seconds', 'Start of the boot step relative to the Taupage boot time',
+     lambda step, boot_start: step['start'] - boot_start),
+    ('taupage_boot_step_duration_seconds', 'Wall clock time of the boot step',
+     lambda step, boot_start: step['duration']),
+    ('taupage_boot_step_cpu_seconds', 'CPU time (user + system) used by the boot step',
+     lambda step, boot_start: step['cpu']),
+    ('taupage_boot_step_exit_code', 'Exit code of the boot step',
+     lambda step, boot_start: step['exit_code']),
+]
+
+
+def render_prometheus(steps: list, boot_start: float, boot_end: float, exit_code: int, hostname: str):
+    '''
+    Render the boot timeline as Prometheus text format
+
+    >>> steps = [{'name': 'mkfs', 'source': 'disks', 'target': '/dev/xvdf',
+    ...           'start': 101, 'duration': 2, 'cpu': 0.5, 'exit_code': 0}]
+    >>> for line in render_prometheus(steps, 100, 110, 0, 'ip-1'):
+    ...     if not line.startswith('#'): print(line)
+    taupage_boot_duration_seconds{hostname="ip-1"} 10.000
+    taupage_boot_exit_code{hostname="ip-1"} 0.000
+    taupage_boot_step_start_seconds{hostname="ip-1",source="disks",step="mkfs",target="/dev/xvdf"} 1.000
+    taupage_boot_step_duration_seconds{hostname="ip-1",source="disks",step="mkfs",target="/dev/xvdf"} 2.000
+    taupage_boot_step_cpu_seconds{hostname="ip-1",source="disks",step="mkfs",target="/dev/xvdf"} 0.500
+    taupage_boot_step_exit_code{hostname="ip-1",source="disks",step="mkfs",target="/dev/xvdf"} 0.000
+    '''
+    lines = ['# HELP taupage_boot_duration_seconds Time from Taupage boot until the end of the init process',
+             '# TYPE taupage_boot_duration_seconds gauge',
+             format_metric('taupage_boot_duration_seconds', {'hostname': hostname}, boot_end - boot_start),
+             '# HELP taupage_boot_exit_code Exit code of the Taupage init process',
+             '# TYPE taupage_boot_exit_code gauge',
+             format_metric('taupage_boot_exit_code', {'hostname': hostname}, exit_code)]
+
+    # the same step might have been recorded several times (e.g. retries), the last one wins
+    unique_steps = {}
+    for step in steps:
+        labels = {'hostname': hostname, 'source': step['source'], 'step': step['name']}
+        if step.get('target'):
+            labels['target'] = step['target']
+        unique_steps[format_labels(labels)] = (labels, step)
+
+    for name, description, value in STEP_METRICS:
+        lines.append('# HELP {} {}'.format(name, description))
+        lines.append('# TYPE {} gauge'.format(name))
+        for key in sorted(unique_steps, key=lambda k: unique_steps[k][1]['start']):
+            labels, step = unique_steps[key]
+            lines.append(format_metric(name, labels, value(step, boot_start)))
+    return lines
+
+
+def export_timeline(boot_start: float, exit_code: int, timeline_file=TIMELINE_FILE,
+                    json_file=TIMELINE_JSON_FILE, textfile_directory=TEXTFILE_COLLECTOR_DIR):
+    '''Write the collected boot timeline as JSON file and Prometheus textfile'''
+    boot_end = time.time()
+    steps = read_timeline(timeline_file)
+    hostname = socket.gethostname()
+
+    atomic_write(json_file, json.dumps({'hostname': hostname,
+                                        'boot_start': boot_start,
+                                        'boot_end': round(boot_end, 3),
+                                        'duration': round(boot_end - boot_start, 3),
+                                        'exit_code': exit_code,
+                                        'steps': steps}, indent=2, sort_keys=True), mode=0o644)
+
+    write_textfile(TIMELINE_PROM_FILE, render_prometheus(steps, boot_start, boot_end, exit_code, hostname),
+                   textfile_directory)
@@ -35,6 +35,45 @@ class TestElbHealthChecker(TestCase):
         healthchecker.TIMEOUT = healthchecker.INTERVAL * 2
         self.assertTrue(healthchecker.is_in_service_from_elb_perspective("test", "test"))
 
+    @patch('elb.elb', spec=elb)
+    def test__are_in_service_should_wait_for_all_load_balancers_and_target_groups(self, elb_mock):
+        elb_client_mock = MagicMock()
+        elb_client_mock.describe_instance_health.return_value = [InstanceState(state='InService')]
+        elb_mock.connect_to_region.return_value = elb_client_mock
+        elbv2_client_mock = MagicMock()
+        elbv2_client_mock.describe_target_health.side_effect = [
+            {'TargetHealthDescriptions': [{'TargetHealth': {'State': 'initial',
+                                                            'Reason': 'Elb.RegistrationInProgress'}}]},
+            {'TargetHealthDescriptions': [{'TargetHealth': {'State': 'healthy'}}]}]
+        healthchecker = ElbHealthChecker("test region")
+        healthchecker._elbv2_client = elbv2_client_mock
+        healthchecker.INTERVAL = 1
+        healthchecker.TIMEOUT = healthchecker.INTERVAL * 2
+        self.assertTrue(healthchecker.are_in_service("test", [('elb', 'test'), ('target-group', 'arn:test')]))
+        # classic ELB was in service right away, only the target group was polled again
+        self.assertEqual(1, elb_client_mock.describe_instance_health.call_count)
+        self.assertEqual(2, elbv2_client_mock.describe_target_health.call_count)
+
+    @patch('elb.elb', spec=elb)
+    def test__get_target_group_health_should_not_be_in_service_if_instance_is_not_registered(self, elb_mock):
+        elbv2_client_mock = MagicMock()
+        elbv2_client_mock.describe_target_health.return_value = {'TargetHealthDescriptions': []}
+        healthchecker = ElbHealthChecker("test region")
+        healthchecker._elbv2_client = elbv2_client_mock
+        self.assertEqual(('unused', 'Target.NotRegistered'),
+                         healthchecker._get_target_group_health("test", "arn:test"))
+
+    @patch('elb.write_textfile')
+    @patch('elb.atomic_write')
+    @patch('elb.get_availability_zone', side_effect=Exception('metadata not available'))
+    @patch('elb.elb', spec=elb)
+    def test__write_report_should_not_fail_if_labels_can_not_be_looked_up(self, elb_mock, az_mock,
+                                                                          write_mock, textfile_mock):
+        healthchecker = ElbHealthChecker("test region")
+        healthchecker.reset_report()
+        healthchecker.write_report()
+        self.assertFalse(write_mock.called)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,73 @@
+from unittest import TestCase
+from unittest.mock import MagicMock
+import hashlib
+import importlib.util
+import os
+import unittest
+
+spec = importlib.util.spec_from_file_location(
+    'register_in_etcd', os.path.join(os.path.dirname(__file__), '../../runtime/opt/taupage/bin/register-in-etcd.py'))
+register_in_etcd = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(register_in_etcd)
+
+EtcdRegistration = register_in_etcd.EtcdRegistration
+
+
+def response(status_code=200, text=''):
+    return MagicMock(status_code=status_code, text=text)
+
+
+class TestEtcdRegistration(TestCase):
+    def registration(self, *responses):
+        cluster = MagicMock()
+        cluster.request.side_effect = list(responses)
+        return EtcdRegistration(cluster, 'taupage/host', 15), cluster
+
+    def test__heartbeat_should_write_the_value_first(self):
+        registration, cluster = self.registration(response(201))
+        self.assertEqual('write', registration.heartbeat('{"a": 1}'))
+        cluster.request.assert_called_once_with('PUT', '/v2/keys/taupage/host', data={'value': '{"a": 1}', 'ttl': 15})
+        self.assertEqual(hashlib.sha256(b'{"a": 1}').hexdigest(), registration.written_hash)
+
+    def test__heartbeat_should_only_refresh_the_ttl_if_the_value_did_not_change(self):
+        registration, cluster = self.registration(response(201), response(200, '{"etcdcluster": "2.3.0"}'),
+                                                  response(200), response(200))
+        registration.heartbeat('{"a": 1}')
+        self.assertEqual('refresh', registration.heartbeat('{"a": 1}'))
+        self.assertEqual('refresh', registration.heartbeat('{"a": 1}'))
+        cluster.request.assert_called_with('PUT', '/v2/keys/taupage/host',
+                                           data={'ttl': 15, 'refresh': 'true', 'prevExist': 'true'})
+        # the version is only checked once
+        self.assertEqual(4, cluster.request.call_count)
+
+    def test__heartbeat_should_always_write_on_etcd_before_2_3(self):
+        registration, cluster = self.registration(response(201), response(200, 'etcd 2.0.11'), response(200))
+        registration.heartbeat('{"a": 1}')
+        self.assertEqual('write', registration.heartbeat('{"a": 1}'))
+        cluster.request.assert_called_with('PUT', '/v2/keys/taupage/host', data={'value': '{"a": 1}', 'ttl': 15})
+
+    def test__heartbeat_should_write_the_value_again_if_the_key_expired(self):
+        registration, cluster = self.registration(response(201), response(200, '{"etcdcluster": "2.3.0"}'),
+                                                  response(404), response(201))
+        registration.heartbeat('{"a": 1}')
+        self.assertEqual('write', registration.heartbeat('{"a": 1}'))
+        cluster.request.assert_called_with('PUT', '/v2/keys/taupage/host', data={'value': '{"a": 1}', 'ttl': 15})
+
+    def test__heartbeat_should_write_the_value_again_if_it_changed(self):
+        registration, cluster = self.registration(response(201), response(201))
+        registration.supports_refresh = True
+        registration.heartbeat('{"a": 1}')
+        self.assertEqual('write', registration.heartbeat('{"a": 2}'))
+        cluster.request.assert_called_with('PUT', '/v2/keys/taupage/host', data={'value': '{"a": 2}', 'ttl': 15})
+        self.assertEqual(hashlib.sha256(b'{"a": 2}').hexdigest(), registration.written_hash)
+
+    def test__heartbeat_should_fail_on_other_errors(self):
+        registration, cluster = self.registration(response(201), response(403))
+        registration.supports_refresh = True
+        registration.heartbeat('{"a": 1}')
+        with self.assertRaises(register_in_etcd.EtcdError):
+            registration.heartbeat('{"a": 1}')
+
+
+if __name__ == '__main__':
+    unittest.main()